@@ -0,0 +1,252 @@
+import heapq
+import ipaddress
+from array import array
+from bisect import bisect_left, bisect_right
+from packet import ip_to_int, int_to_ip
+
+
+def parse_range(spec, hosts_only=False):
+    """Turn "a.b.c.d/n", "first-last" or a single address into inclusive (first, last) ints.
+
+    With hosts_only, a CIDR block loses its network and broadcast addresses
+    (except /31 and /32, which have none).
+    """
+    # ipaddress raises ValueError on bad input and, unlike inet_aton, rejects shorthand like "10.1"
+    if '-' in spec:
+        first, _, last = spec.partition('-')
+        first, last = int(ipaddress.IPv4Address(first.strip())), int(ipaddress.IPv4Address(last.strip()))
+    else:
+        network = ipaddress.IPv4Network(spec.strip(), strict=False)
+        first, last = int(network.network_address), int(network.broadcast_address)
+        if hosts_only and network.prefixlen < 31:
+            first, last = first + 1, last - 1
+    if first > last:
+        raise ValueError(f"Empty address range: {spec!r}")
+    return first, last
+
+
+def subtract_ranges(ranges, exclusions):
+    """Merge inclusive (first, last) ranges and cut the exclusions out of them"""
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], last)
+        else:
+            merged.append([first, last])
+    for ex_first, ex_last in exclusions:
+        remaining = []
+        for first, last in merged:
+            if ex_last < first or ex_first > last:
+                remaining.append([first, last])
+                continue
+            if first < ex_first:
+                remaining.append([first, ex_first - 1])
+            if ex_last < last:
+                remaining.append([ex_last + 1, last])
+        merged = remaining
+    return [(first, last) for first, last in merged]
+
+
+# Per-offset flags. UNKNOWN means free unless hold() listed the address.
+UNKNOWN = 0
+ALLOCATED = 1
+FREE = 2
+
+
+class AddressPool:
+    """IPv4 addresses from one or more ranges, allocated in O(1) without listing them.
+
+    Addresses are numbered by offset across the ranges. One flag byte per
+    address records what is allocated, and a FIFO holds freed offsets;
+    offsets from cursor up have never been handed out. A /10 costs 4 MiB of
+    flags plus 4 bytes per freed address. Never-used addresses go first,
+    then freed ones oldest first, so a just-released address is the last to
+    be reused.
+
+    hold() marks a sorted array of addresses allocated without touching
+    their flags: an UNKNOWN flag is looked up there, by bisection, until
+    the address is next allocated or freed.
+    """
+
+    def __init__(self, ranges):
+        ranges = subtract_ranges(ranges, ())
+        if not ranges:
+            raise ValueError("Address pool is empty")
+        self.range_firsts = [first for first, _ in ranges]
+        self.range_offsets = []  # offset of the first address of each range
+        self.range_ends = []  # offset just past the last address of each range
+        size = 0
+        for first, last in ranges:
+            self.range_offsets.append(size)
+            size += last - first + 1
+            self.range_ends.append(size)
+        self.size = size
+        self.allocated = bytearray(size)  # UNKNOWN, ALLOCATED or FREE per offset
+        self.held = array('I')  # sorted addresses allocated by hold(), where UNKNOWN
+        self.cursor = 0
+        self.freed = array('I')
+        self.freed_head = 0
+        self.free_count = size
+
+    @classmethod
+    def from_specs(cls, specs, exclude=()):
+        """Pool of the host addresses in CIDR blocks or ranges, minus exclusions"""
+        ranges = [parse_range(spec, hosts_only=True) for spec in specs]
+        exclusions = [parse_range(spec) for spec in exclude]
+        return cls(subtract_ranges(ranges, exclusions))
+
+    @property
+    def used_count(self):
+        return self.size - self.free_count
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, ip):
+        return self._offset(ip) is not None
+
+    def _offset(self, ip):
+        value = ip_to_int(ip)
+        index = bisect_right(self.range_firsts, value) - 1
+        if index < 0:
+            return None
+        offset = self.range_offsets[index] + value - self.range_firsts[index]
+        return offset if offset < self.range_ends[index] else None
+
+    def _address(self, offset):
+        return int_to_ip(self._address_int(offset))
+
+    def _address_int(self, offset):
+        index = bisect_right(self.range_offsets, offset) - 1
+        return self.range_firsts[index] + offset - self.range_offsets[index]
+
+    def _held(self, offset):
+        # Whether hold() listed the address at offset
+        held = self.held
+        if not held:
+            return False
+        address = self._address_int(offset)
+        index = bisect_left(held, address)
+        return index < len(held) and held[index] == address
+
+    def _taken(self, offset):
+        flag = self.allocated[offset]
+        if flag != UNKNOWN:
+            return flag == ALLOCATED
+        return self._held(offset)
+
+    def _held_run_end(self, offset):
+        # Offset just past the run of consecutive held addresses starting at
+        # offset, within its range; offset + 1 if offset isn't held
+        held = self.held
+        if not held:
+            return offset + 1
+        address = self._address_int(offset)
+        index = bisect_left(held, address)
+        if index == len(held) or held[index] != address:
+            return offset + 1
+        # held is sorted without repeats, so the run goes on while
+        # held[index + n] == address + n: gallop past its end, then bisect
+        step = 1
+        while index + step < len(held) and held[index + step] == address + step:
+            step *= 2
+        low, high = step // 2, min(step, len(held) - index)
+        while high - low > 1:
+            middle = (low + high) // 2
+            if held[index + middle] == address + middle:
+                low = middle
+            else:
+                high = middle
+        range_index = bisect_right(self.range_offsets, offset) - 1
+        return min(offset + low + 1, self.range_ends[range_index])
+
+    def allocate(self):
+        """Take a free address; returns None when the pool is exhausted"""
+        if not self.free_count:
+            return None
+        allocated = self.allocated
+        while True:
+            if self.cursor < self.size:
+                offset = self.cursor
+                # A run of hold()'s addresses is passed in one step; any of
+                # them freed since are in the FIFO
+                self.cursor = self._held_run_end(offset)
+            else:
+                offset = self.freed[self.freed_head]
+                self.freed_head += 1
+                if self.freed_head * 2 >= len(self.freed):
+                    # Drop the consumed front so the FIFO stays proportional to what it holds
+                    del self.freed[:self.freed_head]
+                    self.freed_head = 0
+            # Skip addresses reserve() or hold() took out of turn
+            if not self._taken(offset):
+                break
+        allocated[offset] = ALLOCATED
+        self.free_count -= 1
+        return self._address(offset)
+
+    def reserve(self, ip):
+        """Allocate a specific address, e.g. a lease restored at startup; False if not free"""
+        offset = self._offset(ip)
+        if offset is None or self._taken(offset):
+            return False
+        self.allocated[offset] = ALLOCATED
+        self.free_count -= 1
+        return True
+
+    def hold(self, addresses):
+        """Allocate a sorted array('I') of integer addresses, e.g. the leases
+        restored at startup, in time independent of its length.
+
+        Call it before anything else is allocated; addresses outside the
+        pool are ignored. Returns how many were in it.
+        """
+        self.held = addresses
+        found = 0
+        for first, offset, end in zip(self.range_firsts, self.range_offsets, self.range_ends):
+            found += bisect_left(addresses, first + end - offset) - bisect_left(addresses, first)
+        self.free_count -= found
+        return found
+
+    def free(self, ip):
+        """Return an address to the pool; returns False if it wasn't allocated"""
+        offset = self._offset(ip)
+        if offset is None or not self._taken(offset):
+            return False
+        self.allocated[offset] = FREE
+        self.freed.append(offset)
+        self.free_count += 1
+        return True
+
+    def is_allocated(self, ip):
+        offset = self._offset(ip)
+        return offset is not None and self._taken(offset)
+
+    def free_addresses(self):
+        """Free addresses in the order they will be handed out"""
+        offset = self.cursor
+        while offset < self.size:
+            if not self._taken(offset):
+                yield self._address(offset)
+            offset = self._held_run_end(offset)
+        for i in range(self.freed_head, len(self.freed)):
+            offset = self.freed[i]
+            if (offset < self.cursor or self._held(offset)) and not self._taken(offset):
+                yield self._address(offset)
+
+    def allocated_addresses(self):
+        """Allocated addresses in address order"""
+        def flagged():
+            offset = self.allocated.find(ALLOCATED)
+            while offset != -1:
+                yield offset
+                offset = self.allocated.find(ALLOCATED, offset + 1)
+
+        def held():
+            for address in self.held:
+                offset = self._offset(address)
+                if offset is not None and self.allocated[offset] == UNKNOWN:
+                    yield offset
+
+        for offset in heapq.merge(flagged(), held()):
+            yield self._address(offset)
@@ -0,0 +1,231 @@
+import asyncio
+from broadcast_server import BroadcastServer, PEER_RETRY_INTERVAL
+from datagram import DatagramPeer
+from logs import get_logger
+from framing import FrameBuffer, RECV_SIZE, frame
+from outbox import OutboxOverflow, OVERFLOW_DROP, OVERFLOW_DISCONNECT
+
+
+log = get_logger('relay')
+
+
+class RelayDatagramProtocol(asyncio.DatagramProtocol):
+    """Hands every datagram on the relay's UDP socket to the relay"""
+
+    def __init__(self, relay):
+        self.relay = relay
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        self.relay.handle_datagram(self.transport, data, address)
+
+    def error_received(self, exc):
+        log.warning("Error receiving datagram: %s", exc)
+
+
+class AsyncBroadcastServer(BroadcastServer):
+    """Relay running every connection on one asyncio event loop.
+
+    Same CLIENT/SERVER handshake and routing as BroadcastServer; peers are
+    keyed by their StreamWriter instead of their socket. Idle connections cost
+    a coroutine and a buffer rather than an OS thread.
+
+    Each transport's write buffer is the connection's outbound queue. When it
+    is over send_queue_bytes the overflow policy applies; under "block" the
+    reader that produced the packet waits for the peer to drain before reading
+    more.
+
+    Queued client packets are routed by a dispatcher task, DISPATCH_BATCH at a
+    time, yielding to the readers between passes.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.congested = set()
+        self.dispatch_ready = None
+
+    def start(self):
+        # Start the event loop and serve until interrupted
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            log.info("Shutting down broadcast server...")
+        finally:
+            self.server_socket.close()
+            self.remove_unix_path()
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle_stream, sock=self.server_socket)
+        unix_servers = [await asyncio.start_unix_server(self.handle_stream, sock=listener)
+                        for listener in self.unix_listeners]
+        self.dispatch_ready = asyncio.Event()
+        self.start_metrics()
+        dispatcher = asyncio.create_task(self.dispatch_forever())
+        monitor = asyncio.create_task(self.monitor_servers()) if self.heartbeat_interval else None
+        if self.udp_socket is not None:
+            await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: RelayDatagramProtocol(self), sock=self.udp_socket)
+        peer_tasks = []
+        for peer_socket, address in self.peer_links:
+            reader, writer = await asyncio.open_connection(sock=peer_socket)
+            peer_tasks.append(asyncio.create_task(self.serve_peer(reader, writer, address, FrameBuffer())))
+        for address in self.peer_addresses:
+            peer_tasks.append(asyncio.create_task(self.maintain_peer_link(address)))
+        async with server:
+            await server.serve_forever()
+
+    async def monitor_servers(self):
+        # Health-check task: probes and evictions run on the loop like all other sends
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                self.check_server_health()
+            except Exception as e:
+                log.error("Error checking server health: %s", e)
+
+    async def dispatch_forever(self):
+        # Route queued client packets, one bounded pass at a time
+        while True:
+            await self.dispatch_ready.wait()
+            self.dispatch_ready.clear()
+            while True:
+                try:
+                    dispatched = self.dispatch_pending()
+                except Exception as e:
+                    log.error("Error dispatching packets: %s", e)
+                    dispatched = 0
+                await self.drain_congested()
+                if not dispatched:
+                    break
+                # Let readers queue newer (possibly more urgent) packets
+                await asyncio.sleep(0)
+
+    async def drain_congested(self):
+        """Wait for every connection over its send queue limit to drain"""
+        while self.congested:
+            writer = self.congested.pop()
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+
+    async def maintain_peer_link(self, address):
+        """Keep an outbound link to a peer relay open, reconnecting whenever it drops"""
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(*address)
+                writer.write(frame("RELAY".encode('utf-8')))
+            except OSError as e:
+                log.warning("Failed to connect to relay peer %s: %s", address, e)
+                await asyncio.sleep(PEER_RETRY_INTERVAL)
+                continue
+            
+            await self.serve_peer(reader, writer, address, FrameBuffer())
+            await asyncio.sleep(PEER_RETRY_INTERVAL)
+
+    async def serve_peer(self, reader, writer, address, buffer):
+        # Route packets from a relay peer until the link closes
+        writer.transport.set_write_buffer_limits(high=self.send_queue_bytes)
+        peer_id = self.add_peer(writer, address)
+        try:
+            await self.read_frames(reader, buffer,
+                                   lambda frames: self.handle_peer_frames(writer, peer_id, frames))
+        except Exception as e:
+            log.warning("Error handling relay peer %s messages: %s", peer_id, e)
+        finally:
+            self.disconnect_peer(writer, peer_id)
+
+    async def handle_stream(self, reader, writer):
+        # Handle a new connection and determine if it's a DHCP server, client or relay peer
+        # Unix peers are usually unnamed; show the listener's path instead
+        address = writer.get_extra_info('peername') or writer.get_extra_info('sockname')
+        writer.transport.set_write_buffer_limits(high=self.send_queue_bytes)
+        buffer = FrameBuffer()
+        try:
+            data = await self.read_frame(reader, buffer)
+            if data is None:
+                writer.close()
+                return
+            connection_type = data.decode('utf-8')
+        except Exception as e:
+            log.warning("Error handling connection: %s", e)
+            writer.close()
+            return
+
+        if connection_type == "SERVER":
+            server_id = self.add_dhcp_server(writer, address)
+            try:
+                await self.read_frames(reader, buffer,
+                                       lambda frames: self.handle_server_frames(writer, server_id, frames))
+            except Exception as e:
+                log.warning("Error handling server %s messages: %s", server_id, e)
+            finally:
+                self.disconnect_server(writer, server_id)
+        elif connection_type == "CLIENT":
+            client_id = self.add_client(writer, address)
+            try:
+                await self.read_frames(reader, buffer,
+                                       lambda frames: self.handle_client_frames(writer, client_id, frames))
+            except Exception as e:
+                log.warning("Error handling client %s messages: %s", client_id, e)
+            finally:
+                self.disconnect_client(writer, client_id)
+        elif connection_type == "RELAY":
+            await self.serve_peer(reader, writer, address, buffer)
+        else:
+            log.warning("Unknown connection type: %s", connection_type)
+            writer.close()
+
+    async def read_frame(self, reader, buffer):
+        """Wait for one complete frame; returns None if the peer closed"""
+        while True:
+            payload = buffer.next_frame()
+            if payload is not None:
+                return payload
+            data = await reader.read(RECV_SIZE)
+            if not data:
+                return None
+            buffer.feed(data)
+
+    async def read_frames(self, reader, buffer, handle_frames):
+        """Pass every batch of complete frames to handle_frames until the peer closes"""
+        while True:
+            handle_frames(buffer.drain())
+            await self.drain_congested()
+            data = await reader.read(RECV_SIZE)
+            if not data:
+                return
+            buffer.feed(data)
+
+    def send_queue_depth(self):
+        """Bytes waiting in transport write buffers"""
+        with self.lock:
+            connections = list(self.dhcp_servers) + list(self.clients) + list(self.peers)
+        return sum(connection.transport.get_write_buffer_size() for connection in connections
+                   if not isinstance(connection, DatagramPeer))
+
+    def _wake_dispatcher(self):
+        """Wake the dispatcher task"""
+        if self.dispatch_ready is not None:
+            self.dispatch_ready.set()
+
+    def _send(self, connection, data):
+        """Queue one framed payload on the peer's transport (never blocks)"""
+        if isinstance(connection, DatagramPeer):
+            connection.send(data)
+            return
+        if connection.transport.get_write_buffer_size() >= self.send_queue_bytes:
+            if self.send_overflow == OVERFLOW_DROP:
+                self.send_queue_drops += 1
+                return
+            if self.send_overflow == OVERFLOW_DISCONNECT:
+                raise OutboxOverflow("Send queue full")
+            self.congested.add(connection)
+        connection.write(frame(data))
+
+    def _close(self, connection):
+        """Close a peer connection"""
+        connection.close()
@@ -1,214 +1,892 @@
+import errno
+import heapq
+import itertools
+import os
+import random
+import stat
 import socket
 import threading
-import pickle
 import time
-from packet import Packet, DISCOVER, OFFER, REQUEST, ACK, NOT_NEEDED, RELEASE, CLOSEACK,KEEPALIVE
+from datagram import DatagramPeer
+from logs import get_logger
+from metrics import MetricsRegistry, serve_metrics
+from framing import FrameBuffer, RECV_SIZE, recv_frame, send_frame
+from outbox import Outbox, OVERFLOW_DROP, OVERFLOW_POLICIES
+from packet import Packet, DISCOVER, OFFER, REQUEST, ACK, NOT_NEEDED, RELEASE, CLOSEACK, KEEPALIVE, POOL_STATUS, HEARTBEAT, NAK, make_pool_status, pool_counts, pool_tid_prefix, tid_prefix
+from ratelimit import TokenBucket
+from routing import RoutingCache
+from scheduling import PriorityScheduler, PACKET_PRIORITY, PRIORITY_NAMES
+
+log = get_logger('relay')
+
+# How long a tid1 route outlives the client's last packet. The default covers
+# a lease (servers hold addresses for up to 210s); after a RELEASE the route
+# is only needed until the CLOSEACK comes back.
+ROUTE_TTL = 240.0
+RELEASE_ROUTE_TTL = 30.0
+ROUTE_MAX_SIZE = 100000
+# Per-connection outbound queue limit, and what to do when a peer falls behind
+SEND_QUEUE_BYTES = 1 << 20
+# Seconds between attempts to (re)connect an outbound relay peer link
+PEER_RETRY_INTERVAL = 2.0
+# The relay probes each DHCP server every HEARTBEAT_INTERVAL seconds and
+# evicts one it has not heard from for HEARTBEAT_MISSES intervals (0 = off)
+HEARTBEAT_INTERVAL = 1.0
+HEARTBEAT_MISSES = 3
+# How many of the least loaded DHCP servers each DISCOVER goes to (0 = all)
+DISCOVER_FANOUT = 2
+# DISCOVER admission: token-bucket rates (per second) and bursts, per client
+# and for the whole relay process; a rate of 0 disables that limit
+CLIENT_DISCOVER_RATE = 2.0
+CLIENT_DISCOVER_BURST = 5
+GLOBAL_DISCOVER_RATE = 500.0
+GLOBAL_DISCOVER_BURST = 1000
+# Client packets wait in per-class queues of this many packets; the
+# dispatcher routes at most DISPATCH_BATCH of them per pass
+DISPATCH_QUEUE_SIZE = 10000
+DISPATCH_BATCH = 256
+# Packet types only a DHCP server sends; over UDP they identify a server
+# the relay has no record of (e.g. one the heartbeat check evicted)
+SERVER_PACKET_TYPES = frozenset((OFFER, ACK, CLOSEACK, NAK, POOL_STATUS, HEARTBEAT))
 
 class BroadcastServer:
-    def __init__(self, host='localhost', port=5000):
+    """Relay between DHCP clients and servers, one thread per connection.
+
+    Relays can be federated: each one connects to the relays passed as peers
+    (handshake "RELAY") and DISCOVERs, follow-ups and replies cross those
+    links one hop. Peers must form a full mesh with one link per pair, i.e.
+    for every two relays exactly one lists the other. Each relay tells its
+    peers how loaded its emptiest DHCP server is, so DISCOVER fan-out picks
+    among local servers and peers alike and the federation as a whole sends
+    each DISCOVER to discover_fanout servers.
+
+    Routing (handle_*_frames, broadcast/forward, disconnect) only touches
+    connections through _send and _close, so other I/O engines can reuse it.
+    Routing decides targets under the lock and sends after releasing it;
+    sends only enqueue on the peer's bounded outbound queue.
+
+    Server replies are routed as soon as they are read. Client packets (and
+    client packets relayed by peers) are queued by priority class and routed
+    by a dispatcher, RELEASE/KEEPALIVE/REQUEST first and DISCOVER last.
+
+    With udp_port set, one UDP socket also serves datagram clients and
+    servers; see handle_datagram. With unix_path set, co-located DHCP
+    servers can connect over a Unix domain socket instead of TCP.
+    """
+
+    def __init__(self, host='localhost', port=5000, backlog=socket.SOMAXCONN,
+                 route_ttl=ROUTE_TTL, route_max_size=ROUTE_MAX_SIZE,
+                 send_queue_bytes=SEND_QUEUE_BYTES, send_overflow=OVERFLOW_DROP, reuse_port=False,
+                 peers=(), discover_fanout=DISCOVER_FANOUT,
+                 client_discover_rate=CLIENT_DISCOVER_RATE, client_discover_burst=CLIENT_DISCOVER_BURST,
+                 global_discover_rate=GLOBAL_DISCOVER_RATE, global_discover_burst=GLOBAL_DISCOVER_BURST,
+                 dispatch_queue_size=DISPATCH_QUEUE_SIZE, udp_port=None, unix_path=None,
+                 metrics_port=None, heartbeat_interval=HEARTBEAT_INTERVAL, heartbeat_misses=HEARTBEAT_MISSES):
+        if send_overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown send overflow policy: {send_overflow!r}")
         self.host = host
         self.port = port
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # Several relay processes share the port; the kernel spreads connections over them
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(10)
+        self.server_socket.listen(backlog)
+        # Optional UDP transport: one socket serves every datagram client and server
+        self.udp_socket = None
+        if udp_port is not None:
+            self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            if reuse_port:
+                self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.udp_socket.bind((self.host, udp_port))
+        # Optional Unix domain stream listeners for DHCP servers on this host
+        self.unix_path = unix_path
+        self.unix_listeners = []
+        if unix_path is not None:
+            self.unix_listeners.append(bind_unix_listener(unix_path, backlog))
         
         # Store connected clients and servers with their socket connections
         self.dhcp_servers = {}  # {server_socket: server_info}
         self.clients = {}  # {client_socket: client_info}
+        # Other relays this one forwards to; see handle_peer_frames
+        self.peers = {}  # {peer_socket: peer_info}
+        self.peer_links = []  # [(peer_socket, address)] to attach when starting
+        self.peer_addresses = list(peers)  # [(host, port)] to connect to when starting
+        # IDs are never reused, so log lines and metrics keep meaning one connection
+        self.server_ids = itertools.count(1)
+        self.client_ids = itertools.count(1)
+        self.peer_ids = itertools.count(1)
+        
+        # Health checks: see check_server_health
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_misses = heartbeat_misses
+        self.heartbeat_evictions = 0
+        
+        # Outbound queues: {socket: Outbox}
+        self.outboxes = {}
+        self.send_queue_bytes = send_queue_bytes
+        self.send_overflow = send_overflow
+        self.send_queue_drops = 0
         
         # Lock for thread safety
-        self.lock = threading.Lock()
-        self.tid1_to_client_socket = {}
+        self.lock = threading.RLock()
+        # Routing index: every client-originated packet records its tid1 here,
+        # so replies are routed with one lookup and never by probing
+        self.tid1_to_client_socket = RoutingCache(default_ttl=route_ttl, max_size=route_max_size)
+        self.unknown_tid1_drops = 0
+        # Learned from OFFERs: which server owns each tid2, so follow-up
+        # packets are unicast instead of sent to every server
+        self.tid2_to_server_socket = RoutingCache(default_ttl=route_ttl, max_size=route_max_size)
+        self.unknown_tid2_broadcasts = 0
+        # tid2s owned by servers that went away: follow-ups for them get a NAK
+        # straight back instead of being broadcast to servers that don't know them
+        self.dead_tid2s = RoutingCache(default_ttl=route_ttl, max_size=route_max_size)
+        self.dead_server_naks = 0
+        # Each server's tid_prefix(), from its POOL_STATUS reports: a tid2 goes
+        # to the live server that issued it even when its cached route is to
+        # that server's old connection or it has none, e.g. a lease a
+        # restarted server restored, instead of being NAKed as dead
+        self.tid2_prefix_owners = {}  # {prefix: server_socket}
+        # DISCOVERs go to the discover_fanout servers with the emptiest pools,
+        # as last reported in their POOL_STATUS packets
+        self.discover_fanout = discover_fanout
+        # Admission control: client DISCOVERs over either rate limit are shed
+        # before they are routed, so a storm cannot drain every pool
+        self.client_discover_rate = client_discover_rate
+        self.client_discover_burst = client_discover_burst
+        # UDP clients have no connection to hang a bucket on: theirs live here,
+        # keyed by DatagramPeer. An idle bucket refills completely within
+        # burst / rate seconds, so it can expire then without loosening the limit.
+        bucket_ttl = max(client_discover_burst / client_discover_rate, 1.0) if client_discover_rate > 0 else 1.0
+        self.datagram_discover_buckets = RoutingCache(default_ttl=bucket_ttl, max_size=route_max_size)
+        self.global_discover_bucket = TokenBucket(global_discover_rate, global_discover_burst)
+        self.shed_client_discovers = 0
+        self.shed_global_discovers = 0
+        # Client-originated packets are queued by priority class and routed
+        # by a dispatcher, so lease traffic overtakes a backlog of DISCOVERs
+        self.scheduler = PriorityScheduler(dispatch_queue_size)
         
-        print(f"Broadcast server started on {self.host}:{self.port}")
+        # Routing for each packet type, by direction
+        # (client DISCOVERs are collected per read and broadcast as a batch)
+        self.server_handlers = {
+            OFFER: self.forward_to_client,
+            ACK: self.forward_to_client,
+            CLOSEACK: self.forward_to_client,
+            NAK: self.forward_to_client,
+        }
+        self.client_handlers = {
+            REQUEST: self.forward_to_server,
+            NOT_NEEDED: self.forward_to_server,
+            RELEASE: self.forward_to_server,
+            KEEPALIVE: self.forward_to_server,
+        }
+        
+        # Metrics, scraped in Prometheus text format when metrics_port is set
+        self.metrics_port = metrics_port
+        self.metrics = MetricsRegistry()
+        self.register_metrics()
+        
+        log.info("Broadcast server started on %s:%s", self.host, self.port)
+
+    def register_metrics(self):
+        """Create the relay's metrics; existing counters are read at scrape time"""
+        metrics = self.metrics
+        self.packets_received = metrics.counter(
+            'relay_packets_received_total', "Packets received, by type and source", ('type', 'source'))
+        self.packets_forwarded = metrics.counter(
+            'relay_packets_forwarded_total', "Packets sent on, by type and target", ('type', 'target'))
+        self.forward_latency = metrics.histogram(
+            'relay_forward_latency_seconds', "Time from reading a packet to handing it to its targets",
+            ('type', 'source'))
+        self.discover_batches = metrics.counter(
+            'relay_discover_batches_total', "DISCOVER batches fanned out")
+        self.discover_fanout_sends = metrics.counter(
+            'relay_discover_fanout_total', "Servers and peers DISCOVER batches were sent to")
+        metrics.counter('relay_dropped_packets_total', "Packets dropped or shed, by reason", ('reason',),
+                        function=lambda: {
+                            ('unknown_tid1',): self.unknown_tid1_drops,
+                            ('shed_client_rate',): self.shed_client_discovers,
+                            ('shed_global_rate',): self.shed_global_discovers,
+                            ('send_queue_full',): self.send_queue_drops,
+                            ('dispatch_queue_full',): sum(self.scheduler.dropped),
+                        })
+        metrics.counter('relay_heartbeat_evictions_total', "DHCP servers evicted for missing heartbeats",
+                        function=lambda: self.heartbeat_evictions)
+        metrics.counter('relay_dead_server_naks_total', "Follow-ups answered with NAK because their server is gone",
+                        function=lambda: self.dead_server_naks)
+        metrics.counter('relay_unknown_tid2_broadcasts_total', "Follow-ups sent to every server for lack of a tid2 route",
+                        function=lambda: self.unknown_tid2_broadcasts)
+        tables = (('tid1', self.tid1_to_client_socket), ('tid2', self.tid2_to_server_socket))
+        metrics.counter('relay_route_lookups_total', "Routing cache lookups, by table and result", ('table', 'result'),
+                        function=lambda: {(name, result): cache.stats()[result]
+                                          for name, cache in tables for result in ('hits', 'misses')})
+        metrics.counter('relay_route_evictions_total', "Routes removed before use, by table and reason", ('table', 'reason'),
+                        function=lambda: {(name, reason): cache.stats()[reason]
+                                          for name, cache in tables
+                                          for reason in ('expired', 'evicted_lru', 'evicted_disconnect')})
+        metrics.gauge('relay_routes', "Routes currently cached, by table", ('table',),
+                      function=lambda: {(name,): len(cache) for name, cache in tables})
+        metrics.gauge('relay_dispatch_queue_depth', "Client packets waiting for dispatch, by priority class", ('class',),
+                      function=lambda: {(name,): len(queue)
+                                        for name, queue in zip(PRIORITY_NAMES, self.scheduler.queues)})
+        # Queueing latency per class: rate(wait_seconds_total) / rate(dispatched_total) is the mean
+        metrics.counter('relay_dispatched_total', "Client packets taken from the dispatch queues, by priority class",
+                        ('class',), function=lambda: self.scheduler_stat('dispatched'))
+        metrics.counter('relay_dispatch_wait_seconds_total', "Time client packets spent queued before dispatch, by priority class",
+                        ('class',), function=lambda: self.scheduler_stat('wait_total'))
+        metrics.gauge('relay_dispatch_wait_max_seconds', "Longest any client packet has waited for dispatch, by priority class",
+                      ('class',), function=lambda: self.scheduler_stat('wait_max'))
+        metrics.gauge('relay_send_queue_bytes', "Bytes queued for sending over all connections",
+                      function=self.send_queue_depth)
+        metrics.gauge('relay_connections', "Open connections, by kind", ('kind',),
+                      function=lambda: {('server',): len(self.dhcp_servers), ('client',): len(self.clients),
+                                        ('peer',): len(self.peers)})
+
+    def scheduler_stat(self, key):
+        # {(class,): value} of one PriorityScheduler.stats() entry, for a labelled metric
+        return {(name,): stats[key] for name, stats in self.scheduler.stats().items()}
+
+    def start_metrics(self):
+        """Serve /metrics on metrics_port, if one was given"""
+        if self.metrics_port is not None:
+            serve_metrics(self.metrics, self.host, self.metrics_port)
+            log.info("Metrics served on http://%s:%s/metrics", self.host, self.metrics_port)
 
     def start(self):
         #Start the broadcast server and listen for connections
+        for peer_socket, address in self.peer_links:
+            self.register_peer(peer_socket, address, FrameBuffer())
+        for address in self.peer_addresses:
+            threading.Thread(target=self.maintain_peer_link, args=(address,), daemon=True).start()
+        threading.Thread(target=self.dispatch_forever, daemon=True).start()
+        if self.heartbeat_interval:
+            threading.Thread(target=self.monitor_servers, daemon=True).start()
+        self.start_metrics()
+        if self.udp_socket is not None:
+            threading.Thread(target=self.serve_datagrams, daemon=True).start()
+        for listener in self.unix_listeners:
+            threading.Thread(target=self.accept_forever, args=(listener,), daemon=True).start()
         try:
-            while True:
-                client_socket, address = self.server_socket.accept()
-                threading.Thread(target=self.handle_connection, args=(client_socket, address)).start()
+            self.accept_forever(self.server_socket)
         except KeyboardInterrupt:
-            print("Shutting down broadcast server...")
+            log.info("Shutting down broadcast server...")
         finally:
             self.server_socket.close()
+            self.remove_unix_path()
+
+    def accept_forever(self, listener):
+        # Accept connections on a TCP or Unix listener, one thread each
+        while True:
+            connection, address = listener.accept()
+            # Unix peers are usually unnamed; show the listener's path instead
+            address = address or listener.getsockname()
+            threading.Thread(target=self.handle_connection, args=(connection, address)).start()
+
+    def add_unix_listener(self, listener):
+        """Accept on an already-bound Unix listener too (e.g. one shared by sharded workers)"""
+        self.unix_listeners.append(listener)
+
+    def remove_unix_path(self):
+        """Remove the Unix socket file this relay bound"""
+        if self.unix_path is not None:
+            try:
+                os.unlink(self.unix_path)
+            except FileNotFoundError:
+                pass
 
     def handle_connection(self, connection, address):
-        #Handle a new connection and determine if it's a DHCP server or client
+        #Handle a new connection and determine if it's a DHCP server, client or relay peer
         try:
-            # Receive connection type (server or client)
-            data = connection.recv(1024)
+            # Receive connection type (server or client) as the first frame;
+            # anything read past it stays in the buffer for the message loop
+            buffer = FrameBuffer()
+            data = recv_frame(connection, buffer)
+            if data is None:
+                connection.close()
+                return
             connection_type = data.decode('utf-8')
             
             if connection_type == "SERVER":
-                self.register_dhcp_server(connection, address)
+                self.register_dhcp_server(connection, address, buffer)
             elif connection_type == "CLIENT":
-                self.register_client(connection, address)
+                self.register_client(connection, address, buffer)
+            elif connection_type == "RELAY":
+                self.register_peer(connection, address, buffer)
             else:
-                print(f"Unknown connection type: {connection_type}")
+                log.warning("Unknown connection type: %s", connection_type)
                 connection.close()
         except Exception as e:
-            print(f"Error handling connection: {e}")
+            log.warning("Error handling connection: %s", e)
             connection.close()
 
-    def register_dhcp_server(self, server_socket, address):
-        #Register a new DHCP server
+    def serve_datagrams(self):
+        # Read the UDP socket; each datagram is handled as it arrives
+        while True:
+            try:
+                data, address = self.udp_socket.recvfrom(RECV_SIZE)
+            except OSError as e:
+                log.warning("Error receiving datagram: %s", e)
+                continue
+            self.handle_datagram(self.udp_socket, data, address)
+
+    def handle_datagram(self, endpoint, data, address):
+        """Route one datagram. A datagram saying SERVER registers its sender as
+        a DHCP server, as does one carrying server replies; anything else
+        from any other sender is a client packet."""
+        peer = DatagramPeer(endpoint, address)
         with self.lock:
-            server_id = len(self.dhcp_servers) + 1
+            server_info = self.dhcp_servers.get(peer)
+        try:
+            if data == b"SERVER":
+                # Servers repeat the handshake periodically, so a restarted relay relearns them
+                if server_info is None:
+                    self.add_dhcp_server(peer, address)
+            elif server_info is not None:
+                self.handle_server_frames(peer, server_info['id'], [data])
+            else:
+                packets = Packet.decode_many(data)
+                if any(packet.packet_type in SERVER_PACKET_TYPES for packet in packets):
+                    # A server we evicted but which is still up: take it back
+                    # rather than pass its replies on to servers as a client's
+                    server_id = self.add_dhcp_server(peer, address)
+                    self.handle_server_frames(peer, server_id, [data])
+                else:
+                    # Clients over UDP are stateless: only their tid1 routes are kept
+                    self.handle_client_packets(peer, address, packets, time.perf_counter())
+        except ValueError as e:
+            log.warning("Dropping bad datagram from %s: %s", address, e)
+
+    def add_dhcp_server(self, server_socket, address):
+        #Record a new DHCP server connection and return its id
+        with self.lock:
+            server_id = next(self.server_ids)
             self.dhcp_servers[server_socket] = {
                 'id': server_id,
-                'address': address
+                'address': address,
+                'free': None,  # pool counts, unknown until the first POOL_STATUS
+                'used': None,
+                'last_seen': time.monotonic()
             }
         
-        print(f"DHCP Server {server_id} connected from {address}")
-        
-        # Start thread to listen for server messages
-        threading.Thread(target=self.handle_server_messages, args=(server_socket, server_id)).start()
+        log.info("DHCP Server %s connected from %s", server_id, address)
+        return server_id
 
-    def register_client(self, client_socket, address):
-        # Register a new client
+    def add_client(self, client_socket, address):
+        # Record a new client connection and return its id
         with self.lock:
-            client_id = len(self.clients) + 1
+            client_id = next(self.client_ids)
             self.clients[client_socket] = {
                 'id': client_id,
                 'address': address,
-                'ip': '0.0.0.0'  # Initial IP
+                'ip': '0.0.0.0',  # Initial IP
+                'discover_bucket': TokenBucket(self.client_discover_rate, self.client_discover_burst)
             }
         
-        print(f"Client {client_id} connected from {address}")
+        log.info("Client %s connected from %s", client_id, address)
+        return client_id
+
+    def add_peer(self, peer_socket, address):
+        # Record a new relay peer connection and return its id
+        with self.lock:
+            peer_id = next(self.peer_ids)
+            self.peers[peer_socket] = {
+                'id': peer_id,
+                'address': address,
+                'free': None,  # pool counts of its emptiest server, unknown until it reports
+                'used': None
+            }
+        
+        log.info("Relay peer %s linked at %s", peer_id, address)
+        return peer_id
+
+    def add_peer_link(self, peer_socket, address):
+        """Attach an already-connected relay peer socket when the relay starts"""
+        self.peer_links.append((peer_socket, address))
+
+    def maintain_peer_link(self, address):
+        """Keep an outbound link to a peer relay open, reconnecting whenever it drops"""
+        while True:
+            try:
+                peer_socket = socket.create_connection(address)
+                send_frame(peer_socket, "RELAY".encode('utf-8'))
+            except OSError as e:
+                log.warning("Failed to connect to relay peer %s: %s", address, e)
+                time.sleep(PEER_RETRY_INTERVAL)
+                continue
+            
+            self.open_outbox(peer_socket)
+            peer_id = self.add_peer(peer_socket, address)
+            self.handle_peer_messages(peer_socket, peer_id, FrameBuffer())
+            time.sleep(PEER_RETRY_INTERVAL)
+
+    def register_dhcp_server(self, server_socket, address, buffer):
+        #Register a new DHCP server
+        self.open_outbox(server_socket)
+        server_id = self.add_dhcp_server(server_socket, address)
+        
+        # Start thread to listen for server messages
+        threading.Thread(target=self.handle_server_messages, args=(server_socket, server_id, buffer)).start()
+
+    def register_client(self, client_socket, address, buffer):
+        # Register a new client
+        self.open_outbox(client_socket)
+        client_id = self.add_client(client_socket, address)
         
         # Start thread to listen for client messages
-        threading.Thread(target=self.handle_client_messages, args=(client_socket, client_id)).start()
+        threading.Thread(target=self.handle_client_messages, args=(client_socket, client_id, buffer)).start()
+
+    def register_peer(self, peer_socket, address, buffer):
+        # Register a new relay peer
+        self.open_outbox(peer_socket)
+        peer_id = self.add_peer(peer_socket, address)
+        
+        # Start thread to listen for peer messages
+        threading.Thread(target=self.handle_peer_messages, args=(peer_socket, peer_id, buffer), daemon=True).start()
+
+    def learn_server_route(self, packet, connection):
+        # Remember which connection owns tid2, from packets coming back from a server
+        if packet.packet_type is OFFER or packet.packet_type is ACK:
+            self.tid2_to_server_socket.put(packet.tid2, connection)
+        elif packet.packet_type is CLOSEACK:
+            self.tid2_to_server_socket.discard(packet.tid2)
+
+    def handle_server_frames(self, server_socket, server_id, frames):
+        # Route every packet in frames received from a DHCP server
+        received_at = time.perf_counter()
+        if frames:
+            self.mark_server_alive(server_socket)
+        for data in frames:
+            # A frame may carry a single packet or a batch
+            for packet in Packet.decode_many(data):
+                if packet.packet_type is POOL_STATUS:
+                    # Load report for DISCOVER fan-out; not forwarded
+                    self.update_pool_status(server_socket, packet)
+                    continue
+                if packet.packet_type is HEARTBEAT:
+                    continue  # echo of our probe; mark_server_alive already counted it
+                log.debug("Received %s packet from DHCP Server %s", packet.packet_type, server_id)
+                self.packets_received.inc(packet.packet_type.name, 'server')
+                self.learn_server_route(packet, server_socket)
+                
+                # Process the packet based on type
+                handler = self.server_handlers.get(packet.packet_type)
+                if handler is not None:
+                    handler(packet)
+                    self.forward_latency.observe(time.perf_counter() - received_at, packet.packet_type.name, 'server')
+
+    def mark_server_alive(self, server_socket):
+        # Anything a server sends proves it is alive
+        server_info = self.dhcp_servers.get(server_socket)
+        if server_info is not None:
+            server_info['last_seen'] = time.monotonic()
+
+    def check_server_health(self):
+        """Evict servers silent for heartbeat_misses intervals and probe the rest"""
+        deadline = time.monotonic() - self.heartbeat_interval * self.heartbeat_misses
+        with self.lock:
+            dead = [(server_socket, server_info['id']) for server_socket, server_info in self.dhcp_servers.items()
+                    if server_info['last_seen'] < deadline]
+        for server_socket, server_id in dead:
+            log.warning("DHCP Server %s missed %d heartbeats, evicting it", server_id, self.heartbeat_misses)
+            self.heartbeat_evictions += 1
+            self.disconnect_server(server_socket, server_id)
+        
+        probe = Packet(current_ip=None, packet_type=HEARTBEAT).serialize()
+        for server_socket, server_id, disconnect in self.server_targets(include_peers=False):
+            try:
+                self._send(server_socket, probe)
+            except Exception as e:
+                log.warning("Error sending heartbeat to DHCP Server %s: %s", server_id, e)
+                disconnect(server_socket, server_id)
+
+    def monitor_servers(self):
+        # Health-check thread for the threaded engine
+        while True:
+            time.sleep(self.heartbeat_interval)
+            try:
+                self.check_server_health()
+            except Exception as e:
+                log.error("Error checking server health: %s", e)
+
+    def update_pool_status(self, connection, packet):
+        # Record a server's (or a peer's emptiest server's) latest free/used address counts
+        free, used = pool_counts(packet)
+        with self.lock:
+            info = self.dhcp_servers.get(connection) or self.peers.get(connection)
+            if info is not None:
+                info['free'] = free
+                info['used'] = used
+            is_server = connection in self.dhcp_servers
+            prefix = pool_tid_prefix(packet)
+            if is_server and prefix is not None:
+                self.tid2_prefix_owners[prefix] = connection
+        if is_server:
+            self.advertise_pool_status()
+
+    def advertise_pool_status(self):
+        """Tell every peer the pool counts of our emptiest server (0/0 with no servers)"""
+        with self.lock:
+            if not self.peers:
+                return
+            reported = [item for item in self.dhcp_servers.items() if item[1]['free'] is not None]
+            if reported:
+                best = min(reported, key=lambda item: self._load(item[1]))[1]
+                free, used = best['free'], best['used']
+            elif self.dhcp_servers:
+                return  # nothing known yet; peers keep treating us as empty
+            else:
+                free = used = 0  # no servers: peers should not send us DISCOVERs
+            targets = [(peer_socket, peer_info['id']) for peer_socket, peer_info in self.peers.items()]
+        report = make_pool_status(free, used).serialize()
+        for peer_socket, peer_id in targets:
+            try:
+                self._send(peer_socket, report)
+            except Exception as e:
+                log.warning("Error sending pool status to relay peer %s: %s", peer_id, e)
+                self.disconnect_peer(peer_socket, peer_id)
+
+    def admit_discover(self, client_socket):
+        # Take a token from the client's bucket, then the relay-wide one. A
+        # DISCOVER shed by the relay-wide limit gives the client's token back,
+        # so the client is not charged for other clients' load
+        client_info = self.clients.get(client_socket)
+        if client_info is not None:
+            bucket = client_info['discover_bucket']
+        elif isinstance(client_socket, DatagramPeer):
+            bucket = self.datagram_discover_buckets.get(client_socket)
+            if bucket is None:
+                bucket = TokenBucket(self.client_discover_rate, self.client_discover_burst)
+            # Refresh its TTL: the bucket lives while the client keeps sending
+            self.datagram_discover_buckets.put(client_socket, bucket)
+        else:
+            bucket = None
+        if bucket is not None and not bucket.try_acquire():
+            self.shed_client_discovers += 1
+            return False
+        if not self.global_discover_bucket.try_acquire():
+            if bucket is not None:
+                bucket.refund()
+            self.shed_global_discovers += 1
+            return False
+        return True
+
+    def handle_client_frames(self, client_socket, client_id, frames):
+        # Queue every packet in frames received from a client for dispatch
+        received_at = time.perf_counter()
+        for data in frames:
+            self.handle_client_packets(client_socket, client_id, Packet.decode_many(data), received_at)
+
+    def handle_client_packets(self, client_socket, client_id, packets, received_at):
+        # Queue decoded client packets for dispatch
+        for packet in packets:
+            log.debug("Received %s packet from Client %s", packet.packet_type, client_id)
+            self.packets_received.inc(packet.packet_type.name, 'client')
+            if packet.packet_type is DISCOVER and not self.admit_discover(client_socket):
+                log.debug("Shedding %s from Client %s: over rate limit", packet.packet_type, client_id)
+                continue
+            ttl = RELEASE_ROUTE_TTL if packet.packet_type is RELEASE else None
+            self.tid1_to_client_socket.put(packet.tid1, client_socket, ttl)
+            self.schedule(packet, True, received_at)
+
+    def handle_peer_frames(self, peer_socket, peer_id, frames):
+        # Route packets relayed by a peer. Peers form a full mesh and forward
+        # exactly one hop: client packets from a peer go to our own DHCP
+        # servers only, and server replies from a peer go to our own clients.
+        received_at = time.perf_counter()
+        for data in frames:
+            for packet in Packet.decode_many(data):
+                log.debug("Received %s packet from relay peer %s", packet.packet_type, peer_id)
+                if packet.packet_type is POOL_STATUS:
+                    # The peer's emptiest server, for DISCOVER fan-out; not forwarded
+                    self.update_pool_status(peer_socket, packet)
+                    continue
+                self.packets_received.inc(packet.packet_type.name, 'peer')
+                if packet.packet_type in self.server_handlers:
+                    # Reply from a server behind the peer: follow-ups for tid2 go back to it
+                    self.learn_server_route(packet, peer_socket)
+                    self.server_handlers[packet.packet_type](packet)
+                    self.forward_latency.observe(time.perf_counter() - received_at, packet.packet_type.name, 'peer')
+                    continue
+                
+                # Client packet from behind the peer: replies for tid1 go back to it
+                ttl = RELEASE_ROUTE_TTL if packet.packet_type is RELEASE else None
+                self.tid1_to_client_socket.put(packet.tid1, peer_socket, ttl)
+                self.schedule(packet, False, received_at)
+
+    def schedule(self, packet, include_peers, received_at):
+        # Queue a client packet in its priority class for the dispatcher
+        priority = PACKET_PRIORITY.get(packet.packet_type)
+        if priority is None:
+            return
+        if not self.scheduler.put(priority, (packet, include_peers, received_at)):
+            log.debug("Dropping %s packet: %s queue full", packet.packet_type, PRIORITY_NAMES[priority])
+            return
+        self._wake_dispatcher()
 
-    def handle_server_messages(self, server_socket, server_id):
+    def dispatch_pending(self, limit=DISPATCH_BATCH):
+        """Route up to limit queued client packets, most urgent first; returns how many"""
+        items = self.scheduler.take(limit)
+        # DISCOVERs come out last and leave as one batch per direction
+        discovers = {True: [], False: []}
+        observe = self.forward_latency.observe
+        for packet, include_peers, received_at in items:
+            source = 'client' if include_peers else 'peer'
+            if packet.packet_type is DISCOVER:
+                discovers[include_peers].append((packet, received_at))
+            else:
+                self.client_handlers[packet.packet_type](packet, include_peers=include_peers)
+                observe(time.perf_counter() - received_at, packet.packet_type.name, source)
+        for include_peers, batch in discovers.items():
+            if batch:
+                self.broadcast_to_dhcp_servers([packet for packet, _ in batch], include_peers=include_peers)
+                now = time.perf_counter()
+                source = 'client' if include_peers else 'peer'
+                for _, received_at in batch:
+                    observe(now - received_at, 'DISCOVER', source)
+        return len(items)
+
+    def dispatch_forever(self):
+        # Dispatcher thread: route queued client packets as they arrive
+        while True:
+            self.scheduler.wait()
+            try:
+                self.dispatch_pending()
+            except Exception as e:
+                log.error("Error dispatching packets: %s", e)
+
+    def handle_server_messages(self, server_socket, server_id, buffer):
         # Handle messages from DHCP servers
         try:
             while True:
-                data = server_socket.recv(8192)
+                self.handle_server_frames(server_socket, server_id, buffer.drain())
+                
+                data = server_socket.recv(RECV_SIZE)
                 if not data:
                     break
-                
-                # Deserialize the packet
-                packet = Packet.deserialize(data)
-                print(f"Received {packet.packet_type} packet from DHCP Server {server_id}")
-                
-                # Process the packet based on type
-                if packet.packet_type == OFFER or packet.packet_type == ACK or packet.packet_type == CLOSEACK:
-                    # Forward to the appropriate client using tid1
-                    self.forward_to_client(packet)
+                buffer.feed(data)
                 
         except Exception as e:
-            print(f"Error handling server {server_id} messages: {e}")
+            log.warning("Error handling server %s messages: %s", server_id, e)
         finally:
             self.disconnect_server(server_socket, server_id)
 
-    def handle_client_messages(self, client_socket, client_id):
+    def handle_client_messages(self, client_socket, client_id, buffer):
         # Handle messages from clients
         client_socket.settimeout(5.0) 
         try:
             while True:
+                self.handle_client_frames(client_socket, client_id, buffer.drain())
+                
                 try:
-                    data = client_socket.recv(8192)
+                    data = client_socket.recv(RECV_SIZE)
                     if not data:
                         break
                 except socket.timeout:
                     continue
-                packet = Packet.deserialize(data)
-                print(f"Received {packet.packet_type} packet from Client {client_id}")
-                self.tid1_to_client_socket[packet.tid1] = client_socket
-                if packet.packet_type == DISCOVER:
-                    # Forward discovery packet to all DHCP servers
-                    self.broadcast_to_dhcp_servers(packet)
-                elif packet.packet_type in [REQUEST, NOT_NEEDED, RELEASE,KEEPALIVE]:
-                    # Forward to the appropriate server using tid2
-                    self.forward_to_server(packet)
+                buffer.feed(data)
                 
         except Exception as e:
-            print(f"Error handling client {client_id} messages: {e}")
+            log.warning("Error handling client %s messages: %s", client_id, e)
         finally:
             self.disconnect_client(client_socket, client_id)
 
-    def broadcast_to_dhcp_servers(self, packet):
-        """Forward a discovery packet to all connected DHCP servers"""
+    def handle_peer_messages(self, peer_socket, peer_id, buffer):
+        # Handle messages from a relay peer
+        try:
+            while True:
+                self.handle_peer_frames(peer_socket, peer_id, buffer.drain())
+                
+                data = peer_socket.recv(RECV_SIZE)
+                if not data:
+                    break
+                buffer.feed(data)
+                
+        except Exception as e:
+            log.warning("Error handling relay peer %s messages: %s", peer_id, e)
+        finally:
+            self.disconnect_peer(peer_socket, peer_id)
+
+    def server_targets(self, include_peers):
+        # Snapshot of (connection, id, disconnect) for every server, and optionally every peer
         with self.lock:
-            if not self.dhcp_servers:
-                print("No DHCP servers available")
-                return
+            targets = [(server_socket, server_info['id'], self.disconnect_server)
+                       for server_socket, server_info in self.dhcp_servers.items()]
+            if include_peers:
+                targets += [(peer_socket, peer_info['id'], self.disconnect_peer)
+                            for peer_socket, peer_info in self.peers.items()]
+        return targets
+
+    def pick_dhcp_servers(self, packets, include_peers=True):
+        """Assign each DISCOVER to the discover_fanout least loaded servers or peers.
+
+        Load is pool occupancy (used / total) from the last POOL_STATUS; a
+        server that has not reported yet counts as empty and one with no free
+        addresses as full. A peer counts as its emptiest server and takes one
+        of the slots: DISCOVERs relayed by a peer go to just one of our
+        servers, so fan-out stays discover_fanout across the federation.
+        Each assignment charges the chosen target one address, so a burst
+        spreads out instead of piling onto whichever reported lowest.
+        Returns {connection: (id, [packets], disconnect)}.
+        """
+        with self.lock:
+            candidates = [(server_socket, server_info, self.disconnect_server)
+                          for server_socket, server_info in self.dhcp_servers.items()]
+            if include_peers:
+                fanout = self.discover_fanout
+                candidates += [(peer_socket, peer_info, self.disconnect_peer)
+                               for peer_socket, peer_info in self.peers.items()]
+            else:
+                fanout = 1 if self.discover_fanout else 0
+            if not fanout or fanout >= len(candidates):
+                return {connection: (info['id'], packets, disconnect)
+                        for connection, info, disconnect in candidates}
             
-            print(f"Broadcasting DISCOVER packet to {len(self.dhcp_servers)} DHCP servers")
-            for server_socket in list(self.dhcp_servers.keys()):
-                try:
-                    server_socket.sendall(packet.serialize())
-                except Exception as e:
-                    print(f"Error sending to DHCP server: {e}")
-                    self.disconnect_server(server_socket, self.dhcp_servers[server_socket]['id'])
+            assignments = {}
+            for packet in packets:
+                chosen = heapq.nsmallest(fanout, candidates, key=lambda candidate: self._load(candidate[1]))
+                for connection, info, disconnect in chosen:
+                    assignments.setdefault(connection, (info['id'], [], disconnect))[1].append(packet)
+                    if info['free'] is not None and info['free'] > 0:
+                        info['free'] -= 1
+                        info['used'] += 1
+            return assignments
+
+    @staticmethod
+    def _load(info):
+        # Sort key for pick_dhcp_servers: occupancy, ties broken at random
+        free, used = info['free'], info['used']
+        if free is None:
+            occupancy = 0.0
+        elif free == 0:
+            occupancy = 1.0
+        else:
+            occupancy = used / (free + used)
+        return occupancy, random.random()
+
+    def broadcast_to_dhcp_servers(self, packets, include_peers=True):
+        """Forward discovery packets to the least loaded DHCP servers and relay peers in batches"""
+        batches = [(connection, connection_id, batch, disconnect)
+                   for connection, (connection_id, batch, disconnect)
+                   in self.pick_dhcp_servers(packets, include_peers).items()]
+        if not batches:
+            log.warning("No DHCP servers available")
+            return
+        
+        log.debug("Broadcasting %d %s packet(s) to %d DHCP servers/relay peers", len(packets), DISCOVER, len(batches))
+        self.discover_batches.inc()
+        self.discover_fanout_sends.inc(amount=len(batches))
+        # Targets sharing the full batch share one encoded buffer
+        encoded = {}
+        for connection, connection_id, batch, disconnect in batches:
+            data = encoded.get(id(batch))
+            if data is None:
+                data = encoded[id(batch)] = Packet.encode_many(batch)
+            try:
+                self._send(connection, data)
+                self.packets_forwarded.inc('DISCOVER', self.target_kind(disconnect), amount=len(batch))
+            except Exception as e:
+                log.warning("Error sending to DHCP server: %s", e)
+                disconnect(connection, connection_id)
 
     def forward_to_client(self, packet):
         #Forward a packet to the appropriate client using tid1
+        target_client = self.tid1_to_client_socket.get(packet.tid1)
+        if target_client is None:
+            self.unknown_tid1_drops += 1
+            log.debug("No client found for %s packet with tid1=%s, dropping", packet.packet_type, packet.tid1)
+            return
+        if packet.packet_type is CLOSEACK:
+            # The transaction is over; nothing else will come back for it
+            self.tid1_to_client_socket.discard(packet.tid1)
+        
+        try:
+            log.debug("Forwarding %s packet to client %s", packet.packet_type, packet.tid2)
+            self._send(target_client, packet.serialize())
+            self.packets_forwarded.inc(packet.packet_type.name, 'client')
+        except Exception as e:
+            log.warning("Error forwarding to client: %s", e)
+            with self.lock:
+                client_info = self.clients.get(target_client)
+            if client_info is not None:
+                self.disconnect_client(target_client, client_info['id'])
+
+    def forward_to_server(self, packet, include_peers=True):
+        """Forward a packet to the appropriate server (or relay peer) using tid2"""
+        target_server = self.tid2_to_server_socket.get(packet.tid2)
         with self.lock:
-            target_client = None
-            if packet.tid1 in self.tid1_to_client_socket:
-                target_client = self.tid1_to_client_socket[packet.tid1]
-            else:
-                for client_socket,client_info in self.clients.items():
-                # Find client by checking packets in transit or other criteria
-                    try:
-                    # Send test packet to check if this is the right client
-                        test_packet = Packet(packet_type="TEST", tid1=packet.tid1)
-                        client_socket.sendall(test_packet.serialize())
-                    
-                        client_socket.settimeout(2.0)
-                        try:
-                            response = client_socket.recv(8192)
-                            response_packet = Packet.deserialize(response)
-                    
-                            if response_packet.tid1 == packet.tid1:
-                                target_client = client_socket
-                                self.tid1_to_client_socket[packet.tid1] = client_socket #newline
-                                break
-                        except socket.timeout:
-                            print(f"Error forwarding to client: TIMEOUT")
-                            continue
-
-                        finally:
-                            client_socket.settimeout(None)
-
-                    except Exception as e:
-                        print(f"Error forwarding to client: {e}")
-                        continue
-            
-            if target_client:
-                try:
-                    print(f"Forwarding {packet.packet_type} packet to client {packet.tid2}")
-                    target_client.sendall(packet.serialize())
-                except Exception as e:
-                    print(f"Error forwarding to client: {e}")
-                    client_id = self.clients[target_client]['id']
-                    self.disconnect_client(target_client, client_id)
+            if packet.tid2 is not None:
+                target_server = self.tid2_prefix_owners.get(tid_prefix(packet.tid2), target_server)
+            owner_info = self.dhcp_servers.get(target_server)
+            if owner_info is not None:
+                targets = [(target_server, owner_info['id'], self.disconnect_server)]
+            elif include_peers and target_server in self.peers:
+                owner_info = self.peers[target_server]
+                targets = [(target_server, owner_info['id'], self.disconnect_peer)]
+        if owner_info is not None:
+            if packet.packet_type is NOT_NEEDED:
+                # The server drops the transaction on NOT_NEEDED
+                self.tid2_to_server_socket.discard(packet.tid2)
             else:
-                print(f"No client found for packet with tid1={packet.tid1}")
+                # Client activity keeps the route alive for the lease
+                self.tid2_to_server_socket.put(packet.tid2, target_server)
+        elif self.dead_tid2s.get(packet.tid2) is not None:
+            # The owner went away with the transaction; tell the client at once
+            self.dead_tid2s.discard(packet.tid2)
+            if packet.packet_type is not NOT_NEEDED:
+                self.dead_server_naks += 1
+                log.debug("Server for tid2=%s is gone, answering %s with %s", packet.tid2, packet.packet_type, NAK)
+                self.forward_to_client(packet.replace(packet_type=NAK, offering_ip=None))
+            return
+        else:
+            # Owner unknown: fall back to every server, each ignores tid2s it doesn't own
+            self.unknown_tid2_broadcasts += 1
+            targets = self.server_targets(include_peers)
+        
+        data = packet.serialize()
+        for connection, connection_id, disconnect in targets:
+            try:
+                self._send(connection, data)
+                self.packets_forwarded.inc(packet.packet_type.name, self.target_kind(disconnect))
+            except Exception as e:
+                log.warning("Error forwarding to server: %s", e)
+                disconnect(connection, connection_id)
 
-    def forward_to_server(self, packet):
-        """Forward a packet to the appropriate server using tid2"""
-        with self.lock:
-            target_server = None
-            for server_socket, server_info in self.dhcp_servers.items():
-                try:
-                    server_socket.sendall(packet.serialize())
-                except Exception as e:
-                    print(f"Error forwarding to server: {e}")
-                    self.disconnect_server(server_socket, server_info['id'])
+    def target_kind(self, disconnect):
+        # Metrics label for a (connection, id, disconnect) target
+        return 'peer' if disconnect == self.disconnect_peer else 'server'
 
     def disconnect_server(self, server_socket, server_id):
         """Handle server disconnection"""
         with self.lock:
             if server_socket in self.dhcp_servers:
                 del self.dhcp_servers[server_socket]
-                print(f"DHCP Server {server_id} disconnected")
+                log.info("DHCP Server %s disconnected", server_id)
+            # Its transactions died with it; remember them so follow-ups fail fast
+            # (unless a server with the same prefix comes back for them)
+            for tid2 in self.tid2_to_server_socket.remove_connection(server_socket):
+                self.dead_tid2s.put(tid2, server_id)
+            for prefix in [prefix for prefix, owner in self.tid2_prefix_owners.items() if owner is server_socket]:
+                del self.tid2_prefix_owners[prefix]
+            
+            try:
+                self._close(server_socket)
+            except:
+                pass
+        # Our emptiest server may have changed
+        self.advertise_pool_status()
+
+    def disconnect_peer(self, peer_socket, peer_id):
+        """Handle relay peer disconnection"""
+        with self.lock:
+            if peer_socket in self.peers:
+                del self.peers[peer_socket]
+                log.info("Relay peer %s disconnected", peer_id)
+            self.tid1_to_client_socket.remove_connection(peer_socket)
+            self.tid2_to_server_socket.remove_connection(peer_socket)
             
             try:
-                server_socket.close()
+                self._close(peer_socket)
             except:
                 pass
 
@@ -217,13 +895,152 @@ class BroadcastServer:
         with self.lock:
             if client_socket in self.clients:
                 del self.clients[client_socket]
-                print(f"Client {client_id} disconnected")
+                log.info("Client %s disconnected", client_id)
+            self.tid1_to_client_socket.remove_connection(client_socket)
             
             try:
-                client_socket.close()
+                self._close(client_socket)
             except:
                 pass
 
+    def open_outbox(self, connection):
+        """Create the outbound queue and writer thread for a new connection"""
+        def on_error(error):
+            # Wake the connection's reader so it runs the normal disconnect path
+            log.warning("Error sending to peer: %s", error)
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        
+        self.outboxes[connection] = Outbox(connection, max_bytes=self.send_queue_bytes,
+                                           overflow=self.send_overflow, on_error=on_error)
+
+    def send_queue_depth(self):
+        """Bytes waiting in outbound queues"""
+        return sum(outbox.queued_bytes for outbox in list(self.outboxes.values()))
+
+    def _wake_dispatcher(self):
+        """Tell the dispatcher packets are queued (the scheduler's condition already does)"""
+
+    def _send(self, connection, data):
+        """Queue one framed payload for a connected peer, or send it as a datagram"""
+        outbox = self.outboxes.get(connection)
+        if outbox is None:
+            if isinstance(connection, DatagramPeer):
+                connection.send(data)
+                return
+            raise ConnectionError("Connection is closed")
+        if not outbox.put(data):
+            self.send_queue_drops += 1
+
+    def _close(self, connection):
+        """Close a peer connection"""
+        outbox = self.outboxes.pop(connection, None)
+        if outbox is not None:
+            outbox.close()
+        connection.close()
+
+def bind_unix_listener(path, backlog=socket.SOMAXCONN):
+    """Bind a listening Unix stream socket at path, replacing a stale socket file.
+
+    A socket file someone is still listening on is left alone: binding then
+    fails with EADDRINUSE instead of silently taking over a running relay's path.
+    """
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except ConnectionRefusedError:
+                os.unlink(path)  # Nobody listening: left behind by a relay that died
+            else:
+                raise OSError(errno.EADDRINUSE, f"Another process is listening on {path}")
+            finally:
+                probe.close()
+    except FileNotFoundError:
+        pass
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(backlog)
+    return listener
+
 if __name__ == "__main__":
-    server = BroadcastServer()
-    server.start()
+    import argparse
+    from logs import add_logging_arguments, configure_from_args
+    
+    parser = argparse.ArgumentParser(description="DHCP broadcast relay")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads',
+                        help="threads: one OS thread per connection; asyncio: single-threaded event loop")
+    parser.add_argument('--route-ttl', type=float, default=ROUTE_TTL,
+                        help="seconds a tid1 route lives after the client's last packet")
+    parser.add_argument('--route-max-size', type=int, default=ROUTE_MAX_SIZE,
+                        help="maximum tid1 routes before least recently used ones are evicted")
+    parser.add_argument('--send-queue-bytes', type=int, default=SEND_QUEUE_BYTES,
+                        help="outbound bytes queued per connection before the overflow policy applies")
+    parser.add_argument('--send-overflow', choices=OVERFLOW_POLICIES, default=OVERFLOW_DROP,
+                        help="on a full send queue: drop the packet, disconnect the peer, or block the sender")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="relay processes sharing the port via SO_REUSEPORT")
+    parser.add_argument('--discover-fanout', type=int, default=DISCOVER_FANOUT,
+                        help="send each DISCOVER to this many of the least loaded DHCP servers (0 = all)")
+    parser.add_argument('--client-discover-rate', type=float, default=CLIENT_DISCOVER_RATE,
+                        help="DISCOVERs per second admitted from each client (0 = unlimited)")
+    parser.add_argument('--client-discover-burst', type=int, default=CLIENT_DISCOVER_BURST,
+                        help="DISCOVERs a client may send back to back before its rate applies")
+    parser.add_argument('--global-discover-rate', type=float, default=GLOBAL_DISCOVER_RATE,
+                        help="DISCOVERs per second admitted from all clients of one relay process (0 = unlimited)")
+    parser.add_argument('--global-discover-burst', type=int, default=GLOBAL_DISCOVER_BURST,
+                        help="relay-wide DISCOVER burst size")
+    parser.add_argument('--dispatch-queue-size', type=int, default=DISPATCH_QUEUE_SIZE,
+                        help="client packets queued per priority class before new ones are dropped")
+    parser.add_argument('--udp-port', type=int, default=None,
+                        help="also serve clients and DHCP servers over UDP on this port")
+    parser.add_argument('--unix-path', default=None,
+                        help="also accept connections on a Unix domain socket at this path")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="serve Prometheus metrics at http://HOST:PORT/metrics (workers use PORT + worker id)")
+    add_logging_arguments(parser)
+    parser.add_argument('--heartbeat-interval', type=float, default=HEARTBEAT_INTERVAL,
+                        help="seconds between heartbeats to each DHCP server (0 = no health checks)")
+    parser.add_argument('--heartbeat-misses', type=int, default=HEARTBEAT_MISSES,
+                        help="missed heartbeat intervals before a DHCP server is evicted")
+    parser.add_argument('--peer', action='append', default=[], metavar='HOST:PORT',
+                        help="another relay to federate with (repeatable; list each pair once)")
+    args = parser.parse_args()
+    configure_from_args(args)
+    peers = []
+    for peer in args.peer:
+        peer_host, _, peer_port = peer.rpartition(':')
+        try:
+            peer_port = int(peer_port)
+        except ValueError:
+            peer_port = None
+        if peer_port is None or not 0 < peer_port < 65536:
+            parser.error(f"--peer {peer!r}: expected HOST:PORT with a port from 1 to 65535")
+        peers.append((peer_host or 'localhost', peer_port))
+    
+    if args.engine == 'asyncio':
+        from async_broadcast_server import AsyncBroadcastServer as server_class
+    else:
+        server_class = BroadcastServer
+    options = dict(host=args.host, port=args.port,
+                   route_ttl=args.route_ttl, route_max_size=args.route_max_size,
+                   send_queue_bytes=args.send_queue_bytes, send_overflow=args.send_overflow,
+                   peers=peers, discover_fanout=args.discover_fanout,
+                   client_discover_rate=args.client_discover_rate,
+                   client_discover_burst=args.client_discover_burst,
+                   global_discover_rate=args.global_discover_rate,
+                   global_discover_burst=args.global_discover_burst,
+                   dispatch_queue_size=args.dispatch_queue_size, udp_port=args.udp_port,
+                   unix_path=args.unix_path, metrics_port=args.metrics_port,
+                   heartbeat_interval=args.heartbeat_interval, heartbeat_misses=args.heartbeat_misses)
+    if args.workers > 1:
+        from sharded_relay import run_sharded
+        run_sharded(args.workers, server_class, **options)
+    else:
+        server = server_class(**options)
+        server.start()
+
@@ -0,0 +1,46 @@
+# Over UDP every datagram carries exactly one payload (a packet or a batch),
+# so no length prefix is needed. Stream transports use framing instead.
+TRANSPORT_TCP = 'tcp'
+TRANSPORT_UDP = 'udp'
+TRANSPORTS = (TRANSPORT_TCP, TRANSPORT_UDP)
+MAX_DATAGRAM_SIZE = 65507
+
+# Client retransmission over UDP: first retry after RETRANSMIT_TIMEOUT
+# seconds, doubling each time, giving up after RETRANSMIT_ATTEMPTS retries
+RETRANSMIT_TIMEOUT = 1.0
+RETRANSMIT_ATTEMPTS = 4
+
+
+class DatagramPeer:
+    """Remote address behind the relay's UDP socket, usable as a connection key.
+
+    Peers compare equal by address, so a fresh DatagramPeer built for each
+    datagram finds the routes and server entries recorded for earlier ones.
+    endpoint is anything with sendto(data, address): a socket or an asyncio
+    datagram transport.
+    """
+    __slots__ = ('endpoint', 'address')
+
+    def __init__(self, endpoint, address):
+        self.endpoint = endpoint
+        self.address = address
+
+    def __eq__(self, other):
+        if not isinstance(other, DatagramPeer):
+            return NotImplemented
+        return self.address == other.address
+
+    def __hash__(self):
+        return hash(self.address)
+
+    def __repr__(self):
+        return f"DatagramPeer({self.address!r})"
+
+    def send(self, payload):
+        """Send one payload as a single datagram"""
+        if len(payload) > MAX_DATAGRAM_SIZE:
+            raise ValueError(f"Payload of {len(payload)} bytes does not fit in a datagram")
+        self.endpoint.sendto(payload, self.address)
+
+    def close(self):
+        """Nothing to close: the relay's UDP socket is shared by every peer"""
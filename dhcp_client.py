@@ -2,13 +2,20 @@ import socket
 import threading
 import time
 import random
-import pickle
-import io
-from packet import Packet, DISCOVER, OFFER, REQUEST, ACK, NOT_NEEDED, RELEASE, CLOSEACK,KEEPALIVE
+from datagram import TRANSPORT_TCP, TRANSPORT_UDP, RETRANSMIT_TIMEOUT, RETRANSMIT_ATTEMPTS
+from framing import FrameBuffer, RECV_SIZE, send_frame
+from logs import get_logger
+from packet import Packet, DISCOVER, OFFER, REQUEST, ACK, NOT_NEEDED, RELEASE, CLOSEACK, KEEPALIVE, NAK, ROLE_CLIENT, TransactionIdGenerator, int_to_ip
+
+log = get_logger('client')
 
 class DHCPClient:
-    def __init__(self, client_id, broadcast_host='localhost', broadcast_port=5000):
-        self.client_id = client_id
+    def __init__(self, client_id=None, broadcast_host='localhost', broadcast_port=5000, transport=TRANSPORT_TCP):
+        # client_id doubles as the transaction ID node, so it must be unique among
+        # clients; without one the generator picks a random node and counter start
+        self.tid_generator = TransactionIdGenerator(node_id=client_id, role=ROLE_CLIENT)
+        self.client_id = self.tid_generator.node_id
+        self.transport = transport
         self.broadcast_host = broadcast_host
         self.broadcast_port = broadcast_port
         
@@ -26,6 +33,9 @@ class DHCPClient:
         self.offer_timeout = 15  # seconds to wait for offers
         self.offer_timer = None
         
+        # Over UDP, the last DISCOVER/REQUEST/RELEASE is resent until its reply arrives
+        self.retransmit_timer = None
+        
         # Socket connection to broadcast server
         self.socket = None
         self.connected = False
@@ -35,28 +45,40 @@ class DHCPClient:
         
         # Flag to control the client
         self.running = True
+        
+        # Handlers for packets arriving from the broadcast server
+        self.handlers = {
+            OFFER: self.handle_offer,
+            ACK: self.handle_ack,
+            CLOSEACK: self.handle_closeack,
+            NAK: self.handle_nak,
+        }
     
     def connect_to_broadcast(self):
         # Connect to the broadcast server
         try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((self.broadcast_host, self.broadcast_port))
-            
-            # Identify as a client
-            self.socket.send("CLIENT".encode('utf-8'))
+            if self.transport == TRANSPORT_UDP:
+                # Datagram clients need no handshake; the relay keeps no state for them
+                self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self.socket.connect((self.broadcast_host, self.broadcast_port))
+            else:
+                self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.socket.connect((self.broadcast_host, self.broadcast_port))
+                
+                # Identify as a client
+                send_frame(self.socket, "CLIENT".encode('utf-8'))
             self.connected = True
             
-            print(f"Client {self.client_id} connected to broadcast server")
+            log.info("Client %s connected to broadcast server", self.client_id)
             return True
         except Exception as e:
-            print(f"Failed to connect to broadcast server: {e}")
+            log.error("Failed to connect to broadcast server: %s", e)
             return False
     
     def start(self):
         # Start the DHCP client
         if not self.connect_to_broadcast():
             return
-        print("work2")
         # Start thread to receive messages from broadcast server
         receive_thread = threading.Thread(target=self.receive_messages)
         receive_thread.daemon = True
@@ -78,39 +100,40 @@ class DHCPClient:
     
     def receive_messages(self):
         # Receive and process messages from the broadcast server
+        buffer = FrameBuffer()
         try:
             while self.connected and self.running:
-                data = self.socket.recv(8192)
-                if not data:
-                    print("[ERROR] No data")
-                    break
-
-                buffer = io.BytesIO(data)
                 try:
-                    packet = pickle.load(buffer)
-                except EOFError:
-                    print("[ERROR] Failed to load packet: Incomplete data")
-                except pickle.UnpicklingError:
-                    print("[ERROR] Unpickling error: Data might be corrupted")
-                if packet.packet_type == "TEST":
-                    if self.tid1 is not None and packet.tid1 == self.tid1:
-                        self.socket.sendall(packet.serialize())
+                    data = self.socket.recv(RECV_SIZE)
+                except ConnectionRefusedError:
+                    # UDP only: the relay is not listening; retransmission covers the loss
                     continue
+                if self.transport == TRANSPORT_UDP:
+                    payloads = [data]
+                elif not data:
+                    log.warning("Broadcast server closed the connection")
+                    break
+                else:
+                    buffer.feed(data)
+                    payloads = buffer.drain()
 
-                
-                print(f"\nReceived {packet.packet_type} packet: {packet}")
-                
-                # Process packet based on type
-                if packet.packet_type == OFFER:
-                    self.handle_offer(packet)
-                elif packet.packet_type == ACK:
-                    self.handle_ack(packet)
-                elif packet.packet_type == CLOSEACK:
-                    self.handle_closeack(packet)
+                packets = []
+                for data in payloads:
+                    try:
+                        packets.extend(Packet.decode_many(data))
+                    except ValueError as e:
+                        log.warning("Failed to decode packet: %s", e)
+                for packet in packets:
+                    log.debug("Received %s packet: %s", packet.packet_type, packet)
+                    
+                    # Process packet based on type
+                    handler = self.handlers.get(packet.packet_type)
+                    if handler is not None:
+                        handler(packet)
                 
                 # print("Menu: 1-Request IP, 2-Release IP, 3-Refresh Lease, 0-Exit")
         except Exception as e:
-            print(f"Error receiving messages: {e}")
+            log.warning("Error receiving messages: %s", e)
         finally:
             self.connected = False
     
@@ -118,16 +141,20 @@ class DHCPClient:
         # Handle OFFER packet - add to pending offers list
         with self.lock:
             if self.tid1 == packet.tid1 and self.address_data == 0:
-                print(f"Received offer for IP {packet.offering_ip} from a DHCP server")
-                self.pending_offers.append(packet)
+                log.info("Received offer for IP %s from a DHCP server", int_to_ip(packet.offering_ip))
+                self.cancel_retransmit()
+                # A retransmitted DISCOVER can bring the same offer twice
+                if all(offer.tid2 != packet.tid2 for offer in self.pending_offers):
+                    self.pending_offers.append(packet)
     
     def handle_ack(self, packet):
         # Handle ACK packet - update client IP
         with self.lock:
             if self.tid1 == packet.tid1 and self.tid2 == packet.tid2:
-                self.current_ip = packet.offering_ip
+                self.cancel_retransmit()
+                self.current_ip = int_to_ip(packet.offering_ip)
                 self.address_data = 1
-                print(f"IP address assigned: {self.current_ip}")
+                log.info("IP address assigned: %s", self.current_ip)
                 
                 # Start lease timer
                 self.start_lease_timer()
@@ -136,14 +163,79 @@ class DHCPClient:
         # Handle CLOSEACK packet - reset client IP
         with self.lock:
             if self.tid1 == packet.tid1 and self.tid2 == packet.tid2:
-                self.current_ip = "0.0.0.0"
-                self.address_data = 0
-                self.tid1 = None
-                self.tid2 = None
-                print("IP address released successfully")
+                self.cancel_retransmit()
+                self.clear_address()
+                log.info("IP address released successfully")
                 
                 # Cancel lease timer if active
                 self.cancel_lease_timer()
+
+    def handle_nak(self, packet):
+        # Handle NAK packet - the server owning our transaction is gone
+        with self.lock:
+            if self.tid1 != packet.tid1 or self.tid2 != packet.tid2:
+                return
+            self.cancel_retransmit()
+            self.cancel_lease_timer()
+            # Mid-request we start over right away; a lost lease waits for the user
+            restart = self.address_data == 0
+            self.clear_address()
+        if restart:
+            log.warning("DHCP server went away before acknowledging; discovering again")
+            self.request_ip()
+        else:
+            log.warning("DHCP server holding our lease went away; address dropped")
+
+    def clear_address(self):
+        # Forget the current address and its transaction
+        self.current_ip = "0.0.0.0"
+        self.address_data = 0
+        self.tid1 = None
+        self.tid2 = None
+
+    def send_packet(self, packet, reliable=False):
+        """Send one packet to the relay. Over UDP a reliable packet is resent
+        until cancel_retransmit() is called for its reply."""
+        payload = packet.serialize()
+        if self.transport == TRANSPORT_UDP:
+            self.socket.send(payload)
+            if reliable:
+                self.schedule_retransmit(packet, payload, 1)
+        else:
+            send_frame(self.socket, payload)
+
+    def schedule_retransmit(self, packet, payload, attempt):
+        # Resend payload after an exponentially growing timeout
+        self.cancel_retransmit()
+        timeout = RETRANSMIT_TIMEOUT * 2 ** (attempt - 1)
+        self.retransmit_timer = threading.Timer(timeout, self.retransmit, args=(packet, payload, attempt))
+        self.retransmit_timer.daemon = True
+        self.retransmit_timer.start()
+
+    def retransmit(self, packet, payload, attempt):
+        # Timer callback: resend, or give up after RETRANSMIT_ATTEMPTS tries
+        with self.lock:
+            if self.retransmit_timer is not threading.current_thread():
+                return  # cancelled or superseded while waiting for the lock
+            self.retransmit_timer = None
+            if attempt > RETRANSMIT_ATTEMPTS:
+                log.warning("No reply to %s after %d retransmissions", packet.packet_type, RETRANSMIT_ATTEMPTS)
+                if packet.packet_type is RELEASE:
+                    # The server frees the address when its lease lapses anyway
+                    self.clear_address()
+                return
+            log.debug("Retransmitting %s packet (attempt %d)", packet.packet_type, attempt)
+            try:
+                self.socket.send(payload)
+            except OSError as e:
+                log.warning("Error retransmitting packet: %s", e)
+            self.schedule_retransmit(packet, payload, attempt + 1)
+
+    def cancel_retransmit(self):
+        # Stop resending the outstanding packet
+        if self.retransmit_timer:
+            self.retransmit_timer.cancel()
+            self.retransmit_timer = None
     
     def request_ip(self):
         # Request an IP address from DHCP servers
@@ -153,7 +245,7 @@ class DHCPClient:
                 return
             
             # Generate a new transaction ID
-            self.tid1 = ''.join(random.choices('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789', k=8))
+            self.tid1 = self.tid_generator.next_id()
             self.pending_offers = []
             
             # Create and send discover packet
@@ -165,8 +257,8 @@ class DHCPClient:
                 offering_ip=None
             )
             
-            print(f"Sending DISCOVER packet with TID1={self.tid1}")
-            self.socket.sendall(discover_packet.serialize())
+            log.debug("Sending %s packet with TID1=%s", DISCOVER, self.tid1)
+            self.send_packet(discover_packet, reliable=True)
             
             # Set timer to select from received offers
             self.offer_timeout = 5
@@ -178,18 +270,19 @@ class DHCPClient:
         # Select an offer from the pending offers after timeout
         with self.lock:
             if not self.connected:
-                print("Socket disconnected before sending offers.") # Additional
+                log.warning("Socket disconnected before sending offers.")
                 return
 
+            self.cancel_retransmit()
             if not self.pending_offers:
-                print("No DHCP offers received. Try again.")
+                log.warning("No DHCP offers received. Try again.")
                 #self.tid1 = None
                 return
             
             # Select a random offer
             selected_offer = random.choice(self.pending_offers)
             self.tid2 = selected_offer.tid2
-            print(f"Selected offer for IP {selected_offer.offering_ip}")
+            log.info("Selected offer for IP %s", int_to_ip(selected_offer.offering_ip))
             
             # Send request packet for the selected offer
             request_packet = Packet(
@@ -200,11 +293,10 @@ class DHCPClient:
                 offering_ip=selected_offer.offering_ip
             )
             
-            print(f"Sending REQUEST packet for IP {selected_offer.offering_ip}")
-            self.socket.sendall(request_packet.serialize())
-            print("Pending offers at selection time:")
-            for offer in self.pending_offers:
-                print(f"- {offer.offering_ip}, tid2={offer.tid2}")
+            log.debug("Sending %s packet for IP %s", REQUEST, int_to_ip(selected_offer.offering_ip))
+            self.send_packet(request_packet, reliable=True)
+            log.debug("Pending offers at selection time: %s",
+                      ", ".join(f"{int_to_ip(offer.offering_ip)} (tid2={offer.tid2})" for offer in self.pending_offers))
             # Send not-needed packets for the other offers
             for offer in self.pending_offers:
                 if offer.tid2 != selected_offer.tid2:
@@ -216,12 +308,12 @@ class DHCPClient:
                         offering_ip=offer.offering_ip
                     )
                     
-                    print(f"Sending NOT_NEEDED packet for IP {offer.offering_ip}")
+                    log.debug("Sending %s packet for IP %s", NOT_NEEDED, int_to_ip(offer.offering_ip))
                     try:
-                        self.socket.sendall(not_needed_packet.serialize())
+                        self.send_packet(not_needed_packet)
                         time.sleep(0.1)  
                     except Exception as e:
-                        print(f"Error sending NOT_NEEDED packet: {e}")
+                        log.warning("Error sending NOT_NEEDED packet: %s", e)
             # Clear pending offers
             self.pending_offers = []
     
@@ -241,8 +333,8 @@ class DHCPClient:
                 offering_ip=None
             )
             
-            print(f"Sending RELEASE packet for IP {self.current_ip}")
-            self.socket.sendall(release_packet.serialize())
+            log.debug("Sending %s packet for IP %s", RELEASE, self.current_ip)
+            self.send_packet(release_packet, reliable=True)
             
             # Cancel lease timer if active
             self.cancel_lease_timer()
@@ -256,7 +348,7 @@ class DHCPClient:
         self.lease_timer.daemon = True
         self.lease_timer.start()
         
-        print(f"Lease timer started. IP {self.current_ip} will expire in {self.lease_time} seconds.")
+        log.info("Lease timer started. IP %s will expire in %s seconds.", self.current_ip, self.lease_time)
     
     def refresh_lease(self):
         """Refresh the lease timer"""
@@ -273,16 +365,16 @@ class DHCPClient:
             )
             elapsed = time.time() - self.lease_start_time
             remaining = max(0, self.lease_time - elapsed)
-            print(f"Current lease time: {int(remaining)} seconds")     #bhjdkd
-            print(f"Sending Keepalive packet for IP {self.current_ip}")
-            self.socket.sendall(keepalive_packet.serialize())
+            log.info("Current lease time: %d seconds", remaining)
+            log.debug("Sending %s packet for IP %s", KEEPALIVE, self.current_ip)
+            self.send_packet(keepalive_packet)
                         
             self.start_lease_timer()
-            print(f"Lease refreshed. IP {self.current_ip} will expire in {self.lease_time} seconds.")
+            log.info("Lease refreshed. IP %s will expire in %s seconds.", self.current_ip, self.lease_time)
     
     def lease_expired(self):
         # Handle lease expiration
-        print(f"\nLease expired for IP {self.current_ip}")
+        log.info("Lease expired for IP %s", self.current_ip)
         self.release_ip()
     
     def cancel_lease_timer(self):
@@ -342,14 +434,27 @@ class DHCPClient:
             except:
                 pass
         
-        print(f"Client {self.client_id} disconnected")
+        log.info("Client %s disconnected", self.client_id)
 
 if __name__ == "__main__":
-    import sys
+    import argparse
+    from logs import add_logging_arguments, configure_from_args
+    from packet import check_node_id
+    
+    parser = argparse.ArgumentParser(description="DHCP client")
+    def node_id(value):
+        try:
+            return check_node_id(int(value))
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
     
-    client_id = 1
-    if len(sys.argv) > 1:
-        client_id = int(sys.argv[1])
+    parser.add_argument('client_id', type=node_id, nargs='?', default=None,
+                        help="unique client number, also used in transaction IDs (default: random)")
+    parser.add_argument('--udp', action='store_true', help="talk to the relay over UDP")
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    configure_from_args(args)
     
-    client = DHCPClient(client_id)
+    transport = TRANSPORT_UDP if args.udp else TRANSPORT_TCP
+    client = DHCPClient(args.client_id, transport=transport)
     client.start()
\ No newline at end of file
@@ -1,26 +1,56 @@
+import functools
+import itertools
 import socket
 import threading
 import time
-import random
-import pickle
-from packet import Packet, DISCOVER, OFFER, REQUEST, ACK, NOT_NEEDED, RELEASE, CLOSEACK,KEEPALIVE
+from address_pool import AddressPool
+from datagram import TRANSPORT_TCP, TRANSPORT_UDP
+from expiry import ExpiryQueue
+from lease_store import LeaseStore
+from framing import FrameBuffer, RECV_SIZE, send_frame
+from logs import get_logger
+from packet import Packet, DISCOVER, OFFER, REQUEST, ACK, NOT_NEEDED, RELEASE, CLOSEACK, KEEPALIVE, HEARTBEAT, ROLE_SERVER, TransactionIdGenerator, make_pool_status, tid_prefix, int_to_ip
 
 SERVER_ID = 2
+log = get_logger('server')
+POOL_REPORT_INTERVAL = 5  # seconds between pool occupancy reports to the relay
+MENU_LIST_LIMIT = 256  # addresses the menu prints before summarising the rest
+
+# An address goes FREE -> OFFERED -> BOUND -> FREE. An offer is held only
+# long enough for the client to pick among its offers (it waits 5 seconds)
+# and REQUEST, so offers nobody takes up return to the pool quickly.
+OFFERED = 'OFFERED'
+BOUND = 'BOUND'
+OFFER_HOLD = 15  # seconds an unclaimed offer keeps its address
+LEASE_TIME = 200  # seconds a bound lease lasts unless renewed by KEEPALIVE
+RESTORE_CHUNK = 10000  # restored lease expiries queued per hold of the lock
 
 class DHCPServer:
-    def __init__(self, server_id=SERVER_ID, broadcast_host='localhost', broadcast_port=5000):
+    def __init__(self, server_id=SERVER_ID, broadcast_host='localhost', broadcast_port=5000,
+                 transport=TRANSPORT_TCP, broadcast_path=None, pool=None, exclude=None,
+                 lease_dir=None):
         self.server_id = server_id
+        # Unix domain socket of a relay on the same host; used instead of host/port
+        # when set, carrying the same framed stream as TCP
+        self.broadcast_path = broadcast_path
+        self.transport = TRANSPORT_TCP if broadcast_path is not None else transport
         self.broadcast_host = broadcast_host
         self.broadcast_port = broadcast_port
         
-        # Generate IP address pool for server 1 (192.168.1.x)
-        base_ip = "192.168."+ str(server_id)+"."
-        self.available_ips = [f"{base_ip}{i}" for i in range(2, 255)]
-        self.non_available_ips = []
-        self.non_available_timeout = {}
+        # IP address pool: CIDR blocks or first-last ranges, minus exclusions.
+        # By default server N hands out 192.168.N.2 - 192.168.N.254
+        if pool is None:
+            pool = [f"192.168.{server_id}.0/24"]
+            exclude = [f"192.168.{server_id}.1"] if exclude is None else exclude
+        self.pool = AddressPool.from_specs(pool, exclude or ())
+        # When each transaction ends and its address returns to the pool (monotonic clock)
+        self.expiries = ExpiryQueue()  # {tid2: deadline}
         
-        # Track transaction IDs and their associated IP offers
-        self.transactions = {}  # {tid2: (tid1, offered_ip)}
+        # Track transaction IDs, their addresses and lease states
+        self.transactions = {}  # {tid2: (tid1, offered_ip, OFFERED or BOUND)}
+        # Outstanding offers by client tid1, so a retransmitted DISCOVER gets the same OFFER
+        self.offers_by_tid1 = {}  # {tid1: tid2}
+        self.tid_generator = TransactionIdGenerator(node_id=server_id, role=ROLE_SERVER)
         
         # Socket connection to broadcast server
         self.socket = None
@@ -29,24 +59,50 @@ class DHCPServer:
         self.timeout = 50
         # Lock for thread safety
         self.lock = threading.Lock()
+        # Serializes writes to the relay socket, so nothing sends while holding self.lock
+        self.send_lock = threading.Lock()
+        # Wakes the expiry thread when a deadline earlier than the one it sleeps towards appears
+        self.expiry_changed = threading.Condition(self.lock)
         
         # Flag to control the server
         self.running = True
+        
+        # Durable copy of the bound leases, so a restart doesn't hand out addresses twice
+        self.lease_store = None
+        if lease_dir is not None:
+            self.lease_store = LeaseStore(lease_dir)
+            self.restore_leases()
+        
+        # Handlers for packets that belong to one of our transactions
+        # (DISCOVERs are collected per read and handled as a batch)
+        self.handlers = {
+            REQUEST: self.handle_request,
+            NOT_NEEDED: self.handle_not_needed,
+            RELEASE: self.handle_release,
+            KEEPALIVE: self.handle_keepalive,
+        }
     
     def connect_to_broadcast(self):
         """Connect to the broadcast server"""
         try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((self.broadcast_host, self.broadcast_port))
+            if self.broadcast_path is not None:
+                self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.socket.connect(self.broadcast_path)
+            else:
+                if self.transport == TRANSPORT_UDP:
+                    self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                else:
+                    self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.socket.connect((self.broadcast_host, self.broadcast_port))
             
             # Identify as a DHCP server
-            self.socket.send("SERVER".encode('utf-8'))
+            self.send_payload("SERVER".encode('utf-8'))
             self.connected = True
             
-            print(f"DHCP Server {self.server_id} connected to broadcast server")
+            log.info("DHCP Server %s connected to broadcast server", self.server_id)
             return True
         except Exception as e:
-            print(f"Failed to connect to broadcast server: {e}")
+            log.error("Failed to connect to broadcast server: %s", e)
             return False
     
     def start(self):
@@ -66,6 +122,9 @@ class DHCPServer:
         cleanup_thread = threading.Thread(target=self.cleanup_stale_offers)
         cleanup_thread.daemon = True
         cleanup_thread.start()
+        report_thread = threading.Thread(target=self.report_pool_status)
+        report_thread.daemon = True
+        report_thread.start()
         
         
         # Keep main thread alive
@@ -77,75 +136,124 @@ class DHCPServer:
         finally:
             self.disconnect()
     
+    def send_payload(self, payload):
+        """Send one payload to the relay: a frame over TCP, a datagram over UDP"""
+        with self.send_lock:
+            if self.transport == TRANSPORT_UDP:
+                self.socket.send(payload)
+            else:
+                send_frame(self.socket, payload)
+
     def receive_messages(self):
         """Receive and process messages from the broadcast server"""
+        buffer = FrameBuffer()
         try:
             while self.connected and self.running:
-                data = self.socket.recv(8192)
-                if not data:
+                try:
+                    data = self.socket.recv(RECV_SIZE)
+                except ConnectionRefusedError:
+                    # UDP only: a datagram we sent found no relay listening; keep waiting
+                    continue
+                if self.transport == TRANSPORT_UDP:
+                    payloads = [data]
+                elif not data:
                     break
+                else:
+                    buffer.feed(data)
+                    payloads = buffer.drain()
                 
-                packet = Packet.deserialize(data)
-                print(f"\nReceived {packet.packet_type} packet: {packet}")
-                
-                # Process packet based on type
-                if packet.packet_type == DISCOVER:
-                    self.handle_discover(packet)
-                elif packet.packet_type == REQUEST and packet.tid2 in self.transactions:
-                    self.handle_request(packet)
-                elif packet.packet_type == NOT_NEEDED and packet.tid2 in self.transactions:
-                    self.handle_not_needed(packet)
-                elif packet.packet_type == RELEASE and packet.tid2 in self.transactions:
-                    self.handle_release(packet)
-                elif packet.packet_type == KEEPALIVE and packet.tid2 in self.transactions:
-                    self.handle_keepalive(packet)
+                discovers = []
+                for data in payloads:
+                    for packet in Packet.decode_many(data):
+                        log.debug("Received %s packet: %s", packet.packet_type, packet)
+                        
+                        # Process packet based on type
+                        if packet.packet_type is DISCOVER:
+                            discovers.append(packet)
+                            continue
+                        if packet.packet_type is HEARTBEAT:
+                            self.handle_heartbeat(packet)
+                            continue
+                        handler = self.handlers.get(packet.packet_type)
+                        if handler is not None:
+                            handler(packet)
+                if discovers:
+                    self.handle_discover(discovers)
                 
                 # print("Menu: 1-Available IPs, 2-Non-Available IPs, 3-Disconnect")
         except Exception as e:
-            print(f"Error receiving messages: {e}")
+            log.warning("Error receiving messages: %s", e)
         finally:
             self.connected = False
     
-    def handle_discover(self, packet):
-        """Handle DISCOVER packet - send an OFFER if we have available IPs"""
+    def handle_discover(self, packets):
+        """Handle DISCOVER packets - send OFFERs, in one batch, while we have available IPs"""
         with self.lock:
-            if not self.available_ips:
-                print("No available IP addresses to offer")
-                return
-            
-            # Generate a new tid2 for this transaction
-            tid2 = ''.join(random.choices('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789', k=8))
-            
-            # Select an IP to offer
-            offered_ip = self.available_ips.pop(0)
-            self.non_available_ips.append(offered_ip)
-            self.non_available_timeout[offered_ip] = time.time() + 210
-            
-            # Store transaction info
-            self.transactions[tid2] = (packet.tid1, offered_ip)
-            
-            # Create and send offer packet
-            offer_packet = Packet(
-                current_ip=packet.current_ip,
-                tid1=packet.tid1,
-                tid2=tid2,
-                packet_type=OFFER,
-                offering_ip=offered_ip
-            )
-            
-            print(f"Sending OFFER for IP {offered_ip} with TID2={tid2}")
-            self.socket.sendall(offer_packet.serialize())
+            offers = []
+            for packet in packets:
+                tid2 = self.offers_by_tid1.get(packet.tid1)
+                if tid2 in self.transactions:
+                    # Retransmitted DISCOVER: repeat the offer instead of reserving another address
+                    offers.append(Packet(
+                        current_ip=packet.current_ip,
+                        tid1=packet.tid1,
+                        tid2=tid2,
+                        packet_type=OFFER,
+                        offering_ip=self.transactions[tid2][1]
+                    ))
+                    continue
+                
+                if not self.pool.free_count:
+                    log.warning("No available IP addresses to offer")
+                    break
+                
+                # Generate a new tid2 for this transaction. After a restart the
+                # counter may reach tid2s that restored leases still hold: skip those.
+                tid2 = self.tid_generator.next_id()
+                while self.transaction(tid2) is not None:
+                    tid2 = self.tid_generator.next_id()
+                
+                # Select an IP to offer
+                offered_ip = self.pool.allocate()
+                
+                # Store transaction info; the address is held only briefly until REQUESTed
+                self.transactions[tid2] = (packet.tid1, offered_ip, OFFERED)
+                self.offers_by_tid1[packet.tid1] = tid2
+                self.set_expiry(tid2, OFFER_HOLD)
+                
+                # Create offer packet
+                offers.append(Packet(
+                    current_ip=packet.current_ip,
+                    tid1=packet.tid1,
+                    tid2=tid2,
+                    packet_type=OFFER,
+                    offering_ip=offered_ip
+                ))
+                log.debug("Sending %s for IP %s with TID2=%s", OFFER, offered_ip, tid2)
+        
+        if offers:
+            self.send_payload(Packet.encode_many(offers))
+
+    def handle_heartbeat(self, packet):
+        """Echo the relay's health probe so it keeps routing to us"""
+        self.send_payload(packet.serialize())
 
     def handle_keepalive(self,packet):
         with self.lock:
-            tid1, offered_ip = self.transactions[packet.tid2]
-            if offered_ip in self.non_available_ips:
-                self.non_available_timeout[offered_ip] = time.time() + 200
+            transaction = self.transaction(packet.tid2)
+            if transaction is None:
+                return  # Not ours, or expired since it was dispatched to us
+            tid1, offered_ip, state = transaction
+            if state == BOUND:
+                self.bind(packet.tid2)
             
     def handle_request(self, packet):
         """Handle REQUEST packet - send an ACK"""
         with self.lock:
-            tid1, offered_ip = self.transactions[packet.tid2]
+            transaction = self.transaction(packet.tid2)
+            if transaction is None:
+                return  # Not ours, or expired since it was dispatched to us
+            tid1, offered_ip, state = transaction
             
             # Create and send ACK packet
             ack_packet = Packet(
@@ -156,37 +264,30 @@ class DHCPServer:
                 offering_ip=offered_ip
             )
 
-            self.non_available_timeout[offered_ip]=time.time()+200
-            
-            print(f"Sending ACK for IP {offered_ip}")
-            self.socket.sendall(ack_packet.serialize())
+            # OFFERED -> BOUND; a retransmitted REQUEST just renews the lease.
+            # The ACK goes out once the lease is durable.
+            log.debug("Sending %s for IP %s", ACK, offered_ip)
+            self.bind(packet.tid2, reply=ack_packet.serialize())
             
             # Note: We keep the transaction record for potential release later
     
     def handle_not_needed(self, packet):
         """Handle NOT_NEEDED packet - return IP to pool"""
         with self.lock:
-            tid1, offered_ip = self.transactions[packet.tid2]
-            
-            # Return IP to available pool
-            if offered_ip in self.non_available_ips:
-                self.non_available_ips.remove(offered_ip)
-                self.available_ips.append(offered_ip)
-                print(f"Returned IP {offered_ip} to available pool")
-            
-            # Clean up transaction
-            del self.transactions[packet.tid2]
+            if self.transaction(packet.tid2) is None:
+                return  # Not ours, or expired since it was dispatched to us
+            # Return IP to available pool and clean up transaction
+            tid1, offered_ip, state = self.end_transaction(packet.tid2)
+            log.info("Returned IP %s to available pool", offered_ip)
     
     def handle_release(self, packet):
         """Handle RELEASE packet - return IP to pool and send CLOSEACK"""
         with self.lock:
-            tid1, offered_ip = self.transactions[packet.tid2]
-            
-            # Return IP to available pool
-            if offered_ip in self.non_available_ips:
-                self.non_available_ips.remove(offered_ip)
-                self.available_ips.append(offered_ip)
-                print(f"Released IP {offered_ip} back to available pool")
+            if self.transaction(packet.tid2) is None:
+                return  # Not ours, or expired since it was dispatched to us
+            # Return IP to available pool and clean up transaction
+            tid1, offered_ip, state = self.end_transaction(packet.tid2)
+            log.info("Released IP %s back to available pool", offered_ip)
             
             # Create and send CLOSEACK packet
             closeack_packet = Packet(
@@ -197,11 +298,8 @@ class DHCPServer:
                 offering_ip=None
             )
             
-            print(f"Sending CLOSEACK for released IP {offered_ip}")
-            self.socket.sendall(closeack_packet.serialize())
-            
-            # Clean up transaction
-            del self.transactions[packet.tid2]
+            log.debug("Sending %s for released IP %s", CLOSEACK, offered_ip)
+        self.send_payload(closeack_packet.serialize())
     
     def show_menu(self):
         """Display interactive menu for server"""
@@ -213,14 +311,12 @@ class DHCPServer:
                 if choice == '1':
                     with self.lock:
                         print("\nAvailable IP Addresses:")
-                        for ip in self.available_ips:
-                            print(f"  {ip}")
+                        self.print_addresses(self.pool.free_addresses(), self.pool.free_count)
                 
                 elif choice == '2':
                     with self.lock:
                         print("\nNon-Available IP Addresses:")
-                        for ip in self.non_available_ips:
-                            print(f"  {ip}")
+                        self.print_addresses(self.pool.allocated_addresses(), self.pool.used_count)
                 
                 elif choice == '3':
                     print("Disconnecting from broadcast server...")
@@ -239,35 +335,190 @@ class DHCPServer:
             time.sleep(30)  # Display every 30 seconds
             with self.lock:
                 print("\nPeriodic update - Available IP Addresses:")
-                for ip in self.available_ips:
-                    print(f"  {ip}")
+                self.print_addresses(self.pool.free_addresses(), self.pool.free_count)
+    
+    def print_addresses(self, addresses, count):
+        """Print up to MENU_LIST_LIMIT addresses, then how many were left out"""
+        for ip in itertools.islice(addresses, MENU_LIST_LIMIT):
+            print(f"  {ip}")
+        if count > MENU_LIST_LIMIT:
+            print(f"  ... and {count - MENU_LIST_LIMIT} more")
     
     def disconnect(self):
         """Disconnect from broadcast server"""
         self.running = False
         self.connected = False
         
+        if self.lease_store is not None:
+            self.lease_store.close()
+        
         if self.socket:
             try:
                 self.socket.close()
             except:
                 pass
         
-        print(f"DHCP Server {self.server_id} disconnected")
+        log.info("DHCP Server %s disconnected", self.server_id)
+
+    def report_pool_status(self):
+        """Periodically tell the relay how many addresses are free and used, for load-aware fan-out"""
+        while self.connected and self.running:
+            with self.lock:
+                report = make_pool_status(self.pool.free_count, self.pool.used_count,
+                                          tid_prefix(self.tid_generator.prefix))
+            try:
+                if self.transport == TRANSPORT_UDP:
+                    # The relay keeps no connection for us; repeat the handshake in case it restarted
+                    self.send_payload("SERVER".encode('utf-8'))
+                self.send_payload(report.serialize())
+            except OSError as e:
+                log.warning("Error sending pool status: %s", e)
+            time.sleep(POOL_REPORT_INTERVAL)
+
+    def set_expiry(self, tid2, seconds):
+        """End transaction tid2 in seconds unless renewed; caller holds the lock"""
+        deadline = time.monotonic() + seconds
+        earliest = self.expiries.next_deadline()
+        self.expiries.set(tid2, deadline)
+        if earliest is None or deadline < earliest:
+            self.expiry_changed.notify()
+
+    def transaction(self, tid2):
+        """(tid1, ip, state) of transaction tid2, or None; caller holds the lock.
+
+        A lease restored at startup lives only in the lease store until the
+        first time it is looked up here.
+        """
+        transaction = self.transactions.get(tid2)
+        if transaction is None and self.lease_store is not None:
+            lease = self.lease_store.get(tid2)
+            if lease is not None:
+                tid1, address, _ = lease
+                transaction = self.transactions[tid2] = (tid1, int_to_ip(address), BOUND)
+        return transaction
+
+    def bind(self, tid2, reply=None):
+        """Move tid2 to BOUND, or renew it, for LEASE_TIME; caller holds the lock.
+
+        reply, a payload for the relay, is sent once the lease is durable: at
+        once without a lease store, else by the store's committer thread after
+        its fsync, so the server lock is not held while waiting for the disk.
+        """
+        tid1, ip, state = self.transaction(tid2)
+        self.transactions[tid2] = (tid1, ip, BOUND)
+        self.set_expiry(tid2, LEASE_TIME)
+        if self.lease_store is None:
+            if reply is not None:
+                self.send_payload(reply)
+        else:
+            on_durable = None if reply is None else functools.partial(self.send_durable, reply)
+            self.lease_store.lease(tid2, tid1, ip, time.time() + LEASE_TIME, on_durable)
+
+    def send_durable(self, payload):
+        """Send a reply that waited for its lease to reach the disk"""
+        if not self.connected:
+            return
+        try:
+            self.send_payload(payload)
+        except OSError as e:
+            log.warning("Error sending reply: %s", e)
+
+    def end_transaction(self, tid2):
+        """Forget tid2 and return its address to the pool (-> FREE); caller holds the lock"""
+        tid1, ip, state = self.transaction(tid2)
+        del self.transactions[tid2]
+        if self.offers_by_tid1.get(tid1) == tid2:
+            del self.offers_by_tid1[tid1]
+        self.expiries.discard(tid2)
+        self.pool.free(ip)
+        if state == BOUND and self.lease_store is not None:
+            self.lease_store.release(tid2)
+        return tid1, ip, state
+
+    def restore_leases(self):
+        """Take back the addresses the lease store holds.
+
+        The pool takes the last snapshot's sorted addresses as they are and
+        only the journal since then is applied lease by lease, so even a
+        million leases are back well within a second. Each lease becomes a
+        transaction when a packet for it first arrives (see transaction()),
+        and a background thread queues their expiries, ending those that
+        lapsed while we were down.
+        """
+        self.pool.hold(self.lease_store.base_addresses)
+        ended, held = self.lease_store.changed_addresses()
+        # Ended leases first: an address may have been leased again since
+        for address in ended:
+            self.pool.free(address)
+        for address in held:
+            self.pool.reserve(address)
+        restore_thread = threading.Thread(target=self.schedule_restored)
+        restore_thread.daemon = True
+        restore_thread.start()
+        log.info("Restored %s leases from %s", len(self.lease_store), self.lease_store.directory)
+
+    def schedule_restored(self):
+        """Queue the expiries of restored leases, RESTORE_CHUNK per hold of the
+        lock, and drop those whose address is no longer in our pool"""
+        tid2s = self.lease_store.tid2s()
+        offset = time.monotonic() - time.time()
+        for start in range(0, len(tid2s), RESTORE_CHUNK):
+            with self.lock:
+                items = []
+                for tid2 in tid2s[start:start + RESTORE_CHUNK]:
+                    if tid2 in self.expiries:
+                        continue  # renewed since the restore, or listed twice
+                    lease = self.lease_store.get(tid2)
+                    if lease is None:
+                        continue  # ended since the restore
+                    tid1, address, expires = lease
+                    if address in self.pool:
+                        items.append((tid2, expires + offset))
+                    else:
+                        self.transactions.pop(tid2, None)
+                        self.lease_store.release(tid2)
+                self.expiries.set_many(items)
+                self.expiry_changed.notify()
 
     def cleanup_stale_offers(self):
-        while self.running:
-            time.sleep(1)
-            to_remove = []
-            for ip, timeout in list(self.non_available_timeout.items()):
-                if timeout < time.time():
-                    self.non_available_ips.remove(ip)
-                    self.available_ips.append(ip)
-                    to_remove.append(ip)
-            for ip in to_remove:
-                del self.non_available_timeout[ip] 
+        """End offers and leases as their deadlines pass, sleeping until the next one"""
+        with self.expiry_changed:
+            while self.running:
+                for tid2 in self.expiries.pop_expired(time.monotonic()):
+                    tid1, ip, state = self.end_transaction(tid2)
+                    if state == OFFERED:
+                        log.info("Offer of IP %s was not taken up; returned to available pool", ip)
+                    else:
+                        log.info("Lease on IP %s expired; returned to available pool", ip)
+                deadline = self.expiries.next_deadline()
+                # Bounded wait so a stopped server is noticed even with no deadlines pending
+                timeout = 1.0 if deadline is None else min(max(deadline - time.monotonic(), 0), 1.0)
+                self.expiry_changed.wait(timeout)
 
 if __name__ == "__main__":
-    print(f"Starting DHCP Server {SERVER_ID} (192.168.{SERVER_ID}.x)")
-    server = DHCPServer(server_id=SERVER_ID)
+    import argparse
+    from logs import add_logging_arguments, configure_from_args
+    
+    parser = argparse.ArgumentParser(description=f"DHCP server {SERVER_ID}")
+    parser.add_argument('--udp', action='store_true', help="talk to the relay over UDP")
+    parser.add_argument('--unix', metavar='PATH', default=None,
+                        help="connect to a relay on this host through its Unix domain socket")
+    parser.add_argument('--pool', action='append', metavar='CIDR',
+                        help="address block to hand out, as CIDR or FIRST-LAST (repeatable; "
+                             f"default 192.168.{SERVER_ID}.0/24 without .1)")
+    parser.add_argument('--exclude', action='append', metavar='CIDR',
+                        help="address, CIDR block or FIRST-LAST range never to hand out (repeatable)")
+    parser.add_argument('--lease-dir', metavar='DIR', default=None,
+                        help="keep leases in a journal under DIR so they survive a restart")
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    configure_from_args(args)
+    
+    transport = TRANSPORT_UDP if args.udp else TRANSPORT_TCP
+    try:
+        server = DHCPServer(server_id=SERVER_ID, transport=transport, broadcast_path=args.unix,
+                            pool=args.pool, exclude=args.exclude, lease_dir=args.lease_dir)
+    except ValueError as e:
+        parser.error(str(e))
+    log.info("Starting DHCP Server %s (%s addresses)", SERVER_ID, len(server.pool))
     server.start()
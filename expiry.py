@@ -0,0 +1,67 @@
+import heapq
+
+
+class ExpiryQueue:
+    """Deadlines by key, expired in deadline order with a lazy-deletion min-heap.
+
+    The dict holds each key's current deadline; the heap may also hold
+    entries a later set() or discard() superseded, which are skipped when
+    they surface. set() and each expiry cost O(log n) and discard() O(1),
+    so finding what has expired never means looking at every key. Not
+    thread-safe: callers hold their own lock.
+    """
+
+    def __init__(self):
+        self.deadlines = {}  # {key: deadline}
+        self.heap = []  # [(deadline, key)], including superseded entries
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def get(self, key, default=None):
+        return self.deadlines.get(key, default)
+
+    def set(self, key, deadline):
+        """Expire key at deadline, replacing any earlier deadline for it"""
+        self.deadlines[key] = deadline
+        heapq.heappush(self.heap, (deadline, key))
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            # Mostly superseded entries (e.g. leases renewed over and over): rebuild
+            self.heap = [(deadline, key) for key, deadline in self.deadlines.items()]
+            heapq.heapify(self.heap)
+
+    def set_many(self, items):
+        """set() for a list of (key, deadline) pairs, heapifying once if that is cheaper"""
+        self.deadlines.update(items)
+        entries = [(deadline, key) for key, deadline in items]
+        if len(entries) > len(self.heap):
+            self.heap.extend(entries)
+            heapq.heapify(self.heap)
+        else:
+            for entry in entries:
+                heapq.heappush(self.heap, entry)
+
+    def discard(self, key):
+        """Forget key's deadline; its heap entry goes stale"""
+        return self.deadlines.pop(key, None)
+
+    def next_deadline(self):
+        """Earliest live deadline, or None when nothing is scheduled"""
+        heap = self.heap
+        while heap and self.deadlines.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    def pop_expired(self, now):
+        """Remove and return the keys whose deadline is at or before now"""
+        expired = []
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            deadline, key = heapq.heappop(heap)
+            if self.deadlines.get(key) == deadline:
+                del self.deadlines[key]
+                expired.append(key)
+        return expired
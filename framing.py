@@ -0,0 +1,76 @@
+import struct
+
+# Every message on a stream socket is sent as a frame:
+#   length:u32 (network byte order) | payload
+LENGTH_PREFIX = struct.Struct("!I")
+MAX_FRAME_SIZE = 1 << 20
+RECV_SIZE = 65536
+
+
+def frame(payload):
+    """Prefix a payload with its length so it can be sent on a stream"""
+    return LENGTH_PREFIX.pack(len(payload)) + payload
+
+
+def send_frame(sock, payload):
+    """Send a single framed payload on a stream socket"""
+    sock.sendall(frame(payload))
+
+
+class FrameBuffer:
+    """Per-connection reassembly buffer for length-prefixed frames"""
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+
+    def feed(self, data):
+        """Append bytes read from the socket"""
+        self.buffer += data
+
+    def next_frame(self):
+        """Remove and return the next complete payload, or None if there isn't one yet"""
+        buffer = self.buffer
+        if len(buffer) < LENGTH_PREFIX.size:
+            return None
+        (length,) = LENGTH_PREFIX.unpack_from(buffer)
+        if length > self.max_frame_size:
+            raise ValueError(f"Frame of {length} bytes exceeds limit of {self.max_frame_size}")
+        end = LENGTH_PREFIX.size + length
+        if len(buffer) < end:
+            return None
+        payload = bytes(buffer[LENGTH_PREFIX.size:end])
+        del buffer[:end]
+        return payload
+
+    def drain(self):
+        """Remove and return every complete payload currently buffered"""
+        buffer = self.buffer
+        payloads = []
+        offset = 0
+        available = len(buffer)
+        while available - offset >= LENGTH_PREFIX.size:
+            (length,) = LENGTH_PREFIX.unpack_from(buffer, offset)
+            if length > self.max_frame_size:
+                raise ValueError(f"Frame of {length} bytes exceeds limit of {self.max_frame_size}")
+            start = offset + LENGTH_PREFIX.size
+            end = start + length
+            if end > available:
+                break
+            payloads.append(bytes(buffer[start:end]))
+            offset = end
+        if offset:
+            del buffer[:offset]
+        return payloads
+
+
+def recv_frame(sock, buffer):
+    """Block until one complete frame is available; returns None if the peer closed"""
+    while True:
+        payload = buffer.next_frame()
+        if payload is not None:
+            return payload
+        data = sock.recv(RECV_SIZE)
+        if not data:
+            return None
+        buffer.feed(data)
@@ -0,0 +1,355 @@
+import os
+import re
+import struct
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+from operator import itemgetter
+from logs import get_logger
+from packet import ip_to_int
+
+# A lease directory holds generations of two files. leases-N.snap is every
+# live lease at the moment journal N was started; leases-N.log is every
+# event after that. Loading reads the newest snapshot and replays the
+# journals from its generation on. Both files start with MAGIC.
+#
+# A journal then holds fixed-size records: op, address, tid1, tid2, expiry
+# (Unix time). Leases are keyed by tid2, the transaction that holds them.
+# A snapshot holds one LEASE record per live lease, sorted by tid2, then
+# the same leases' addresses as a sorted array of u32s. Both parts load as
+# flat arrays that are searched by bisection, so a snapshot of millions of
+# leases loads without building an object per lease.
+MAGIC = b'DHCPLS03'
+RECORD = struct.Struct('!BIQQd')
+ADDRESS = struct.Struct('!I')
+LEASE = 1
+RENEW = 2
+RELEASE = 3
+# One field of a record each, for pulling a column out of many records at
+# C speed with column()
+OP_FIELD = struct.Struct(f'!B{RECORD.size - 1}x')
+ADDRESS_FIELD = struct.Struct(f'!xI{RECORD.size - 5}x')
+TID2_OFFSET = RECORD.size - 16
+TID2_FIELD = struct.Struct(f'!{TID2_OFFSET}xQ8x')
+WHOLE_RECORD = struct.Struct(f'{RECORD.size}s')
+SNAPSHOT_MIN_RECORDS = 100000  # journal length that triggers a snapshot...
+SNAPSHOT_RATIO = 0.25  # ...once it is also this large a share of the live lease count
+FILE_NAME = re.compile(r'leases-(\d+)\.(snap|log)')
+
+log = get_logger('server')
+
+
+def column(data, field):
+    """The field (e.g. TID2_FIELD) of every record in data, as a list"""
+    return list(map(itemgetter(0), field.iter_unpack(data)))
+
+
+def unsigned_array(typecode, data):
+    """An array of the big-endian unsigned integers packed back to back in data"""
+    values = array(typecode, data)
+    if sys.byteorder == 'little':
+        values.byteswap()
+    return values
+
+
+def tid2_array(records):
+    """The tid2 of every record in records as an array('Q'), gathered a
+    byte at a time with strided slices rather than an object per record"""
+    packed = bytearray(len(records) // RECORD.size * 8)
+    for byte in range(8):
+        packed[byte::8] = records[TID2_OFFSET + byte::RECORD.size]
+    return unsigned_array('Q', packed)
+
+
+class LeaseStore:
+    """Durable leases: an append-only binary journal with group commit, plus snapshots.
+
+    Updates are queued in memory and a committer thread writes whatever has
+    queued up with one write() and one fsync(), so under load many updates
+    share each fsync while a lone update is still committed at once. sync()
+    waits until everything queued so far is on disk; an on_durable callback
+    passed to lease() is run by the committer once that lease is.
+
+    In memory, the last snapshot stays packed (see above) and changes since
+    then are a dict on top of it. When the journal grows long, another
+    thread merges the two into the next snapshot while updates carry on.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        # The last snapshot: records sorted by tid2, their tid2s, and their sorted addresses
+        self.base = b''
+        self.base_tid2s = array('Q')
+        self.base_addresses = array('I')
+        # {tid2: packed record} of changes since: RELEASE records mark leases that ended.
+        # While a snapshot is being written, the changes it includes are in frozen.
+        self.leases = {}
+        self.frozen = {}
+        self.generation, self.journal_records = self.load()
+        self.count = len(self.base_tid2s) + sum(
+            (record[0] != RELEASE) - (self.base_record(tid2) is not None)
+            for tid2, record in self.leases.items())
+
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.pending = bytearray()
+        self.callbacks = []  # on_durable callbacks for the records in pending
+        self.appended = 0  # records queued so far
+        self.durable = 0  # records fsynced so far
+        self.running = True
+        self.snapshotter = None
+        self.journal = self.open_journal(self.generation)
+        self.committer = threading.Thread(target=self.commit_forever, daemon=True)
+        self.committer.start()
+
+    def path(self, generation, kind):
+        return os.path.join(self.directory, f"leases-{generation:08d}.{kind}")
+
+    def load(self):
+        """Read the newest snapshot and the journals after it; returns (journal generation, records in journals)"""
+        files = {}
+        for name in os.listdir(self.directory):
+            match = FILE_NAME.fullmatch(name)
+            if match:
+                files.setdefault(int(match.group(1)), set()).add(match.group(2))
+        base = max((generation for generation, kinds in files.items() if 'snap' in kinds), default=0)
+        records = 0
+        if 'snap' in files.get(base, ()):
+            self.load_snapshot(self.path(base, 'snap'))
+        for generation in sorted(files):
+            if generation < base:
+                # Superseded by the snapshot; left behind by an interrupted cleanup
+                for kind in files[generation]:
+                    os.unlink(self.path(generation, kind))
+            elif 'log' in files[generation]:
+                records += self.replay(self.path(generation, 'log'))
+        return max(files, default=0), records
+
+    def load_snapshot(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        count, remainder = divmod(len(data) - len(MAGIC), RECORD.size + ADDRESS.size)
+        if data[:len(MAGIC)] != MAGIC or remainder:
+            raise ValueError(f"{path} is not a lease snapshot")
+        end = len(MAGIC) + count * RECORD.size
+        self.base = data[len(MAGIC):end]
+        self.base_tid2s = tid2_array(self.base)
+        self.base_addresses = unsigned_array('I', data[end:])
+
+    def replay(self, path):
+        """Apply the records in one journal to self.leases; returns how many it held"""
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) <= len(MAGIC):
+            return 0
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a lease journal")
+        # A record torn by a crash mid-write is ignored (and cut off by
+        # open_journal() before anything is appended)
+        count = (len(data) - len(MAGIC)) // RECORD.size
+        body = data[len(MAGIC):len(MAGIC) + count * RECORD.size]
+        # The last record for each tid2 wins
+        self.leases.update(zip(column(body, TID2_FIELD), column(body, WHOLE_RECORD)))
+        return count
+
+    def open_journal(self, generation):
+        path = self.path(generation, 'log')
+        journal = open(path, 'ab')
+        size = journal.tell()
+        if size < len(MAGIC):
+            journal.truncate(0)
+            journal.write(MAGIC)
+            journal.flush()
+            os.fsync(journal.fileno())
+            self.sync_directory()
+        elif (size - len(MAGIC)) % RECORD.size:
+            # Drop a record torn by a crash so new ones stay aligned
+            journal.truncate(size - (size - len(MAGIC)) % RECORD.size)
+            os.fsync(journal.fileno())
+        return journal
+
+    def sync_directory(self):
+        """fsync the directory so created and renamed files survive a crash"""
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def base_record(self, tid2):
+        """tid2's record in the last snapshot, or None"""
+        index = bisect_left(self.base_tid2s, tid2)
+        if index < len(self.base_tid2s) and self.base_tid2s[index] == tid2:
+            return self.base[index * RECORD.size:(index + 1) * RECORD.size]
+        return None
+
+    def record(self, tid2):
+        # Caller holds the lock (or is still loading)
+        for layer in (self.leases, self.frozen):
+            record = layer.get(tid2)
+            if record is not None:
+                return None if record[0] == RELEASE else record
+        return self.base_record(tid2)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, tid2):
+        return self.get(tid2) is not None
+
+    def get(self, tid2):
+        """(tid1, address int, expiry) of the lease held by tid2, or None"""
+        with self.lock:
+            record = self.record(tid2)
+        if record is None:
+            return None
+        _, address, tid1, _, expires = RECORD.unpack(record)
+        return tid1, address, expires
+
+    def changed_addresses(self):
+        """(ended, held): addresses of the leases that ended, and that were
+        made or renewed, since the last snapshot"""
+        with self.lock:
+            changes = b''.join(self.leases.values())
+        ended, held = [], []
+        for op, address in zip(column(changes, OP_FIELD), column(changes, ADDRESS_FIELD)):
+            (ended if op == RELEASE else held).append(address)
+        return ended, held
+
+    def tid2s(self):
+        """The tid2 of every live lease; may repeat one"""
+        with self.lock:
+            return list(self.base_tid2s) + list(self.frozen) + list(self.leases)
+
+    def lease(self, tid2, tid1, ip, expires, on_durable=None):
+        """Record that transaction tid2 holds ip until expires (Unix time).
+
+        on_durable, if given, is called without arguments from the committer
+        thread once the record is on disk.
+        """
+        with self.lock:
+            if self.record(tid2) is None:
+                op = LEASE
+                self.count += 1
+            else:
+                op = RENEW
+            record = RECORD.pack(op, ip_to_int(ip), tid1, tid2, expires)
+            self.leases[tid2] = record
+            self.append(record)
+            if on_durable is not None:
+                self.callbacks.append(on_durable)
+
+    def release(self, tid2):
+        """Record that transaction tid2 gave its address back"""
+        with self.lock:
+            record = self.record(tid2)
+            if record is not None:
+                self.count -= 1
+                record = RECORD.pack(RELEASE, ADDRESS_FIELD.unpack(record)[0], 0, tid2, 0.0)
+                self.leases[tid2] = record
+                self.append(record)
+
+    def append(self, record):
+        # Caller holds the lock
+        if not self.pending:
+            self.changed.notify_all()
+        self.pending += record
+        self.appended += 1
+
+    def sync(self):
+        """Wait until every update made so far is on disk"""
+        with self.lock:
+            target = self.appended
+            while self.durable < target and self.committer.is_alive():
+                self.changed.wait(0.1)
+
+    def commit_forever(self):
+        """Write and fsync queued records in groups; snapshot when the journal grows long"""
+        while True:
+            with self.lock:
+                while self.running and not self.pending:
+                    self.changed.wait()
+                if not self.pending:
+                    return
+                batch, self.pending = self.pending, bytearray()
+                callbacks, self.callbacks = self.callbacks, []
+                committed = self.appended
+                self.journal_records += len(batch) // RECORD.size
+                snapshot = (self.snapshotter is None and
+                            self.journal_records >= max(SNAPSHOT_MIN_RECORDS, SNAPSHOT_RATIO * self.count))
+                if snapshot:
+                    # The state after this batch; later records go to the next journal
+                    self.frozen, self.leases = self.leases, {}
+                    self.journal_records = 0
+            self.journal.write(batch)
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            with self.lock:
+                self.durable = committed
+                self.changed.notify_all()
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception:
+                    log.exception("on_durable callback failed")
+            if snapshot:
+                self.generation += 1
+                self.journal.close()
+                self.journal = self.open_journal(self.generation)
+                self.snapshotter = threading.Thread(target=self.write_snapshot, args=(self.generation,))
+                self.snapshotter.start()
+
+    def write_snapshot(self, generation):
+        """Merge the last snapshot with the frozen changes into snapshot generation,
+        then drop the generations before it"""
+        live = dict(zip(self.base_tid2s, column(self.base, WHOLE_RECORD)))
+        live.update(self.frozen)
+        for tid2 in [tid2 for tid2, record in self.frozen.items() if record[0] == RELEASE]:
+            del live[tid2]
+        tid2s = sorted(live)
+        base = b''.join(map(live.__getitem__, tid2s))
+        addresses = array('I', sorted(column(base, ADDRESS_FIELD)))
+        del live
+
+        path = self.path(generation, 'snap')
+        with open(path + '.tmp', 'wb') as f:
+            f.write(MAGIC)
+            f.write(base)
+            if sys.byteorder == 'little':
+                addresses.byteswap()
+            addresses.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        self.sync_directory()
+
+        base_addresses = unsigned_array('I', addresses.tobytes())
+        with self.lock:
+            self.base, self.base_tid2s, self.base_addresses = base, array('Q', tid2s), base_addresses
+            self.frozen = {}
+            self.snapshotter = None
+        for old in range(generation - 1, -1, -1):
+            removed = False
+            for kind in ('snap', 'log'):
+                try:
+                    os.unlink(self.path(old, kind))
+                    removed = True
+                except FileNotFoundError:
+                    pass
+            if not removed:
+                break
+
+    def close(self):
+        """Commit everything queued and stop the committer"""
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+            self.changed.notify_all()
+        self.committer.join()
+        snapshotter = self.snapshotter
+        if snapshotter is not None:
+            snapshotter.join()
+        self.journal.close()
@@ -0,0 +1,133 @@
+import atexit
+import itertools
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from packet import PacketType
+
+# Every module logs under "dhcp"; configure_logging() sets it up once per
+# process. Per-packet traces are DEBUG, address and connection events INFO,
+# problems WARNING and up. Until configure_logging() runs only warnings and
+# errors reach stderr (Python's last-resort handler).
+ROOT_LOGGER = 'dhcp'
+LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'OFF')
+
+_listener = None
+_settings = None  # arguments of the last configure_logging(), to restart after fork
+
+
+def get_logger(name):
+    """Logger for one module"""
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+class PacketTypeSampler(logging.Filter):
+    """Pass one in every N records about each sampled packet type.
+
+    A record is about the first PacketType among its arguments, so call sites
+    need nothing extra: log.debug("Received %s packet", packet.packet_type).
+    Records without one always pass.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = {str(packet_type).upper(): rate for packet_type, rate in rates.items()}
+        self.counters = {name: itertools.count() for name in self.rates}
+
+    def filter(self, record):
+        args = record.args if isinstance(record.args, tuple) else ()
+        for arg in args:
+            if isinstance(arg, PacketType):
+                counter = self.counters.get(arg.name)
+                if counter is None:
+                    return True
+                return next(counter) % self.rates[arg.name] == 0
+        return True
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queues records unformatted; the listener thread formats and writes them.
+
+    Safe within one process because logged arguments (packets, ids,
+    addresses) are not modified after the call.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def parse_sample(specs):
+    """Turn ["DISCOVER=100", ...] into {"DISCOVER": 100, ...}"""
+    rates = {}
+    for spec in specs or ():
+        name, _, rate = spec.partition('=')
+        if name.upper() not in PacketType.__members__ or not rate.isdigit() or int(rate) < 1:
+            raise ValueError(f"Bad sampling spec {spec!r}; expected TYPE=N, e.g. DISCOVER=100")
+        rates[name.upper()] = int(rate)
+    return rates
+
+
+def configure_logging(level='INFO', sample=None, stream=None):
+    """Log at level and above through a background thread; level 'OFF' disables logging.
+
+    sample maps packet type names to N, keeping one in N records about them.
+    Callers never wait on the terminal or a file: records are queued and
+    written by a QueueListener.
+    """
+    global _listener, _settings
+    stop_logging()
+    _settings = (level, sample, stream)
+    root = logging.getLogger(ROOT_LOGGER)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.propagate = False
+    if level == 'OFF':
+        # Above every level, so each log call returns after one cached check
+        root.setLevel(logging.CRITICAL + 1)
+        return
+    root.setLevel(level)
+
+    records = queue.SimpleQueue()
+    handler = DeferredQueueHandler(records)
+    if sample:
+        handler.addFilter(PacketTypeSampler(sample))
+    root.addHandler(handler)
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(logging.Formatter('%(message)s'))
+    _listener = logging.handlers.QueueListener(records, output)
+    _listener.start()
+
+
+def stop_logging():
+    """Flush queued records and stop the listener thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def _restart_in_child():
+    # A forked child (e.g. a sharded relay worker) has no listener thread
+    global _listener
+    if _listener is not None:
+        _listener = None
+        configure_logging(*_settings)
+
+
+atexit.register(stop_logging)
+os.register_at_fork(after_in_child=_restart_in_child)
+
+
+def add_logging_arguments(parser):
+    """Add --log-level and --log-sample to an argparse parser"""
+    parser.add_argument('--log-level', choices=LEVELS, default='INFO',
+                        help="DEBUG shows every packet; OFF disables logging entirely")
+    parser.add_argument('--log-sample', action='append', default=[], metavar='TYPE=N',
+                        help="log one in N records about packets of TYPE (repeatable)")
+
+
+def configure_from_args(args):
+    """configure_logging() from parsed --log-level/--log-sample arguments"""
+    configure_logging(args.log_level, parse_sample(args.log_sample))
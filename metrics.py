@@ -0,0 +1,183 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Histogram buckets are HDR-style: values (in microseconds) below
+# 2 * SUB_BUCKETS are exact, above that every power of two is split into
+# SUB_BUCKETS linear sub-buckets, so any value is kept within 1/SUB_BUCKETS
+# of its true size whatever its magnitude.
+SUB_BUCKET_BITS = 3
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+
+def bucket_index(value):
+    """Bucket holding a non-negative integer value"""
+    if value < 2 * SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    return shift * SUB_BUCKETS + (value >> shift)
+
+
+def bucket_upper_bound(index):
+    """Smallest integer value above bucket index"""
+    if index < 2 * SUB_BUCKETS:
+        return index + 1
+    shift = index // SUB_BUCKETS - 1
+    return (index - shift * SUB_BUCKETS + 1) << shift
+
+
+def format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+               for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Metric:
+    """Base for a named metric family, one value per tuple of label values.
+
+    A metric built with function= has no state of its own: the function is
+    called at scrape time and returns a value, or a {labelvalues: value} dict
+    for a labelled metric.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def collect(self):
+        """Current {labelvalues: value}"""
+        if self.function is None:
+            with self.lock:
+                return dict(self.values)
+        value = self.function()
+        return value if isinstance(value, dict) else {(): value}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for labelvalues, value in sorted(self.collect().items()):
+            lines.append(f"{self.name}{format_labels(self.labelnames, labelvalues)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    """Monotonically increasing count"""
+    kind = 'counter'
+
+    def inc(self, *labelvalues, amount=1):
+        with self.lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+
+class Gauge(Metric):
+    """Value that can go up and down, usually read through function="""
+    kind = 'gauge'
+
+    def set(self, value, *labelvalues):
+        with self.lock:
+            self.values[labelvalues] = value
+
+
+class Histogram(Metric):
+    """Distribution of durations in seconds, kept in HDR-style microsecond buckets"""
+    kind = 'histogram'
+
+    def observe(self, seconds, *labelvalues):
+        index = bucket_index(max(int(seconds * 1e6), 0))
+        with self.lock:
+            state = self.values.get(labelvalues)
+            if state is None:
+                state = self.values[labelvalues] = [{}, 0, 0.0]  # [buckets, count, sum]
+            buckets = state[0]
+            buckets[index] = buckets.get(index, 0) + 1
+            state[1] += 1
+            state[2] += seconds
+
+    def percentile(self, fraction, *labelvalues):
+        """Upper bound, in seconds, of the bucket holding the given fraction of observations"""
+        with self.lock:
+            state = self.values.get(labelvalues)
+            if state is None or not state[1]:
+                return 0.0
+            buckets, count, _ = state
+            rank = fraction * count
+            seen = 0
+            for index in sorted(buckets):
+                seen += buckets[index]
+                if seen >= rank:
+                    return bucket_upper_bound(index) / 1e6
+            return bucket_upper_bound(max(buckets)) / 1e6
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            states = {labelvalues: (dict(state[0]), state[1], state[2])
+                      for labelvalues, state in self.values.items()}
+        for labelvalues, (buckets, count, total) in sorted(states.items()):
+            # Only occupied buckets are listed; cumulative counts as Prometheus expects
+            cumulative = 0
+            for index in sorted(buckets):
+                cumulative += buckets[index]
+                le = (('le', repr(bucket_upper_bound(index) / 1e6)),)
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, labelvalues, le)} {cumulative}")
+            inf = (('le', '+Inf'),)
+            lines.append(f"{self.name}_bucket{format_labels(self.labelnames, labelvalues, inf)} {count}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labelvalues)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labelvalues)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Named metric families, rendered together in Prometheus text format"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=(), function=None):
+        return self.register(Counter(name, documentation, labelnames, function))
+
+    def gauge(self, name, documentation, labelnames=(), function=None):
+        return self.register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name, documentation, labelnames=()):
+        return self.register(Histogram(name, documentation, labelnames))
+
+    def render(self):
+        """Every metric in Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def serve_metrics(registry, host='localhost', port=9100):
+    """Serve registry at http://host:port/metrics from a daemon thread; returns the server"""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # scrapes are not worth a line each
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
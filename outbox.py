@@ -0,0 +1,86 @@
+import threading
+from collections import deque
+from framing import frame
+
+# What Outbox.put does when the queue is full
+OVERFLOW_DROP = 'drop'  # discard the new frame
+OVERFLOW_DISCONNECT = 'disconnect'  # raise OutboxOverflow so the caller drops the peer
+OVERFLOW_BLOCK = 'block'  # wait for the writer to make room (backpressure)
+OVERFLOW_POLICIES = (OVERFLOW_DROP, OVERFLOW_DISCONNECT, OVERFLOW_BLOCK)
+
+
+class OutboxOverflow(ConnectionError):
+    """Raised by Outbox.put under the disconnect policy when the queue is full"""
+
+
+class Outbox:
+    """Bounded outbound queue for one stream socket, drained by its own writer thread.
+
+    Producers only append to the queue, so a slow peer never blocks whoever is
+    routing to it. The writer coalesces everything queued into one sendall;
+    those bytes count against max_bytes until the sendall returns.
+    """
+
+    def __init__(self, sock, max_bytes=1 << 20, overflow=OVERFLOW_DROP, on_error=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow!r}")
+        self.sock = sock
+        self.max_bytes = max_bytes
+        self.overflow = overflow
+        self.on_error = on_error
+        self.frames = deque()
+        self.queued_bytes = 0
+        self.dropped = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def put(self, payload):
+        """Queue one payload; returns False if it was dropped because the queue is full"""
+        data = frame(payload)
+        with self.condition:
+            while True:
+                if self.closed:
+                    raise ConnectionError("Outbox is closed")
+                if self.queued_bytes + len(data) <= self.max_bytes or not self.queued_bytes:
+                    break
+                if self.overflow == OVERFLOW_DROP:
+                    self.dropped += 1
+                    return False
+                if self.overflow == OVERFLOW_DISCONNECT:
+                    raise OutboxOverflow(f"Send queue full ({self.queued_bytes} bytes)")
+                self.condition.wait()
+            self.frames.append(data)
+            self.queued_bytes += len(data)
+            self.condition.notify_all()
+        return True
+
+    def close(self):
+        """Stop the writer; frames still queued are discarded"""
+        with self.condition:
+            self.closed = True
+            self.frames.clear()
+            self.queued_bytes = 0
+            self.condition.notify_all()
+
+    def _write_loop(self):
+        while True:
+            with self.condition:
+                while not self.frames and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                data = b''.join(self.frames)
+                self.frames.clear()
+            try:
+                self.sock.sendall(data)
+            except OSError as e:
+                self.close()
+                if self.on_error is not None:
+                    self.on_error(e)
+                return
+            with self.condition:
+                if not self.closed:
+                    self.queued_bytes -= len(data)
+                    self.condition.notify_all()
@@ -1,40 +1,301 @@
-import pickle
-import random
-import string
+import itertools
+import os
+import socket
+import struct
+import time
+from enum import IntEnum
+
+
+class PacketType(IntEnum):
+    """Message type; the value is the type code used on the wire"""
+    DISCOVER = 1
+    OFFER = 2
+    REQUEST = 3
+    ACK = 4
+    NOT_NEEDED = 5
+    RELEASE = 6
+    CLOSEACK = 7
+    TEST = 8
+    KEEPALIVE = 9
+    POOL_STATUS = 10
+    HEARTBEAT = 11
+    NAK = 12
+
+    def __str__(self):
+        return self.name
+
+    __format__ = object.__format__
+
 
 # Packet Types
-DISCOVER = "DISCOVER"
-OFFER = "OFFER"
-REQUEST = "REQUEST"
-ACK = "ACK"
-NOT_NEEDED = "NOT_NEEDED"
-RELEASE = "RELEASE"
-CLOSEACK = "CLOSEACK"
-TEST = "TEST"
-KEEPALIVE ="KEEPALIVE"
+DISCOVER = PacketType.DISCOVER
+OFFER = PacketType.OFFER
+REQUEST = PacketType.REQUEST
+ACK = PacketType.ACK
+NOT_NEEDED = PacketType.NOT_NEEDED
+RELEASE = PacketType.RELEASE
+CLOSEACK = PacketType.CLOSEACK
+TEST = PacketType.TEST
+KEEPALIVE = PacketType.KEEPALIVE
+POOL_STATUS = PacketType.POOL_STATUS
+HEARTBEAT = PacketType.HEARTBEAT  # relay -> server probe, echoed back unchanged
+NAK = PacketType.NAK  # relay -> client: the server owning tid2 is gone
+
+# Wire format (version 2), all fields in network byte order:
+#   version:u8 | type:u8 | flags:u8 | current_ip:u32 | offering_ip:u32 | tid1:u64 | tid2:u64
+# Absent fields are zero-filled and have their bit cleared in flags.
+#
+# POOL_STATUS (server -> relay, and relay -> peer for its emptiest server)
+# reuses the transaction ID fields as counters, since it belongs to no
+# transaction: tid1 is the number of free addresses, tid2 the number in use.
+# A server's report also carries its tid_prefix() in offering_ip, so the
+# relay can route follow-ups for tid2s it has no route for, such as leases
+# a restarted server restored. Build and read it only through
+# make_pool_status(), pool_counts() and pool_tid_prefix().
+#
+# A batch payload carries many packets back to back in one buffer:
+#   BATCH_VERSION:u8 | count:u32 | count * (type:u8 | flags:u8 | ... | tid2:u64)
+WIRE_VERSION = 2
+WIRE_FORMAT = struct.Struct("!BBBIIQQ")
+BATCH_VERSION = 0x80 | WIRE_VERSION
+BATCH_HEADER = struct.Struct("!BI")
+BATCH_RECORD = struct.Struct("!BBIIQQ")
+BATCH_LIMIT = 32768
+
+FLAG_CURRENT_IP = 0x01
+FLAG_OFFERING_IP = 0x02
+FLAG_TID1 = 0x04
+FLAG_TID2 = 0x08
+
+_TYPES_BY_CODE = {packet_type.value: packet_type for packet_type in PacketType}
+
+# Transaction IDs are 64-bit integers: an 8-bit role and a 24-bit node ID
+# form a 32-bit prefix unique to the issuing client or server, followed by
+# a 32-bit counter.
+ROLE_EPHEMERAL = 0
+ROLE_CLIENT = 1
+ROLE_SERVER = 2
+NODE_BITS = 24
+COUNTER_BITS = 32
+NODE_MASK = (1 << NODE_BITS) - 1
+COUNTER_MASK = (1 << COUNTER_BITS) - 1
+
+
+def check_node_id(node_id):
+    """Return node_id, or raise ValueError if it doesn't fit in NODE_BITS"""
+    if not 0 <= node_id <= NODE_MASK:
+        raise ValueError(f"Node ID must fit in {NODE_BITS} bits (0-{NODE_MASK}): {node_id}")
+    return node_id
+
+
+class TransactionIdGenerator:
+    """Issues unique 64-bit transaction IDs for one node.
+
+    IDs never collide across nodes with distinct (role, node_id) pairs, so a
+    node_id must be unique among its role, e.g. a server's configured number.
+    The counter then starts from the current time in milliseconds, so a
+    restarted node does not reissue recent IDs unless it handed out more than
+    one per millisecond. Without a node_id both the node ID and the counter
+    start are random: two such nodes collide only if they draw the same
+    24-bit node and overlapping stretches of the 32-bit counter.
+    """
+
+    def __init__(self, node_id=None, role=ROLE_EPHEMERAL):
+        if node_id is None:
+            node_id = int.from_bytes(os.urandom(3), 'big')
+            start = int.from_bytes(os.urandom(4), 'big')
+        else:
+            check_node_id(node_id)
+            start = int(time.time() * 1000) & COUNTER_MASK
+        self.node_id = node_id
+        self.prefix = ((role << NODE_BITS) | node_id) << COUNTER_BITS
+        self._counter = itertools.count(start)
+
+    def next_id(self):
+        """Return the next transaction ID (safe to call from any thread)"""
+        return self.prefix | (next(self._counter) & COUNTER_MASK)
+
+
+_default_tids = TransactionIdGenerator()
+
+
+def ip_to_int(ip):
+    """Convert a dotted-quad IPv4 address to an integer (ints and None pass through)"""
+    if ip is None or isinstance(ip, int):
+        return ip
+    return int.from_bytes(socket.inet_aton(ip), 'big')
+
+
+def int_to_ip(value):
+    """Convert an integer IPv4 address back to dotted-quad form"""
+    if value is None:
+        return None
+    return socket.inet_ntoa(value.to_bytes(4, 'big'))
+
+
+def tid_prefix(tid):
+    """The 32-bit role and node prefix of a transaction ID, shared by every ID its node issues"""
+    return tid >> COUNTER_BITS
+
+
+def make_pool_status(free, used, prefix=None):
+    """Build a POOL_STATUS report of free and used address counts, and the
+    sender's tid_prefix() if it is a server (see the wire format above)"""
+    return Packet(current_ip=None, tid1=free, tid2=used, packet_type=POOL_STATUS, offering_ip=prefix)
+
+
+def pool_counts(packet):
+    """Return (free, used) from a POOL_STATUS packet"""
+    return packet.tid1, packet.tid2
+
+
+def pool_tid_prefix(packet):
+    """Return the reporting server's tid_prefix() from a POOL_STATUS packet, or None"""
+    return packet.offering_ip
+
 
 class Packet:
+    """Immutable packet record; use replace() to derive a modified copy"""
+    __slots__ = ('current_ip', 'tid1', 'tid2', 'packet_type', 'offering_ip')
+
     def __init__(self, current_ip="0.0.0.0", tid1=None, tid2=None, packet_type=None, offering_ip=None):
-        self.current_ip = current_ip
-        self.tid1 = tid1 if tid1 else self._generate_transaction_id()
-        self.tid2 = tid2
-        self.packet_type = packet_type
-        self.offering_ip = offering_ip
-    
+        _set_current_ip(self, ip_to_int(current_ip))
+        _set_tid1(self, tid1 if tid1 is not None else self._generate_transaction_id())
+        _set_tid2(self, tid2)
+        _set_packet_type(self, packet_type)
+        _set_offering_ip(self, ip_to_int(offering_ip))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"Packet is immutable; use replace() to change {name!r}")
+
+    def replace(self, **changes):
+        """Return a copy of this packet with the given fields changed"""
+        fields = {name: getattr(self, name) for name in self.__slots__}
+        fields.update(changes)
+        return Packet(**fields)
+
     def _generate_transaction_id(self):
-        """Generate a random 8-character alphanumeric transaction ID"""
-        return ''.join(random.choices(string.ascii_letters + string.digits, k=8))
-    
+        """Generate a transaction ID from this process's default generator"""
+        return _default_tids.next_id()
+
     def serialize(self):
         """Convert packet to bytes for network transmission"""
-        return pickle.dumps(self)
-    
+        return encode_packet(self)
+
     @staticmethod
     def deserialize(data):
         """Convert bytes back to packet object"""
-        return pickle.loads(data)
-    
+        return decode_packet(data)
+
+    @staticmethod
+    def encode_many(packets):
+        """Convert a list of packets to one payload (a batch unless there is only one)"""
+        if len(packets) == 1:
+            return encode_packet(packets[0])
+        return encode_batch(packets)
+
+    @staticmethod
+    def decode_many(data):
+        """Convert a single-packet or batch payload to a list of packets"""
+        if data and data[0] == BATCH_VERSION:
+            return decode_batch(data)
+        return [decode_packet(data)]
+
     def __str__(self):
         """String representation of packet for logging"""
-        return (f"Packet[Type={self.packet_type}, Current IP={self.current_ip}, "
-                f"TID1={self.tid1}, TID2={self.tid2}, Offering IP={self.offering_ip}]")
+        return (f"Packet[Type={self.packet_type}, Current IP={int_to_ip(self.current_ip)}, "
+                f"TID1={self.tid1}, TID2={self.tid2}, Offering IP={int_to_ip(self.offering_ip)}]")
+
+
+# Slot setters bypass the immutability guard when building packets
+_set_current_ip = Packet.current_ip.__set__
+_set_tid1 = Packet.tid1.__set__
+_set_tid2 = Packet.tid2.__set__
+_set_packet_type = Packet.packet_type.__set__
+_set_offering_ip = Packet.offering_ip.__set__
+_new_packet = object.__new__
+
+
+def _wire_fields(packet):
+    flags = 0
+    current_ip = packet.current_ip
+    offering_ip = packet.offering_ip
+    tid1 = packet.tid1
+    tid2 = packet.tid2
+    if current_ip is not None:
+        flags |= FLAG_CURRENT_IP
+    else:
+        current_ip = 0
+    if offering_ip is not None:
+        flags |= FLAG_OFFERING_IP
+    else:
+        offering_ip = 0
+    if tid1 is not None:
+        flags |= FLAG_TID1
+    else:
+        tid1 = 0
+    if tid2 is not None:
+        flags |= FLAG_TID2
+    else:
+        tid2 = 0
+    if packet.packet_type not in _TYPES_BY_CODE:
+        raise ValueError(f"Unknown packet type: {packet.packet_type!r}")
+    return packet.packet_type, flags, current_ip, offering_ip, tid1, tid2
+
+
+def _build_packet(type_code, flags, current_ip, offering_ip, tid1, tid2):
+    try:
+        packet_type = _TYPES_BY_CODE[type_code]
+    except KeyError:
+        raise ValueError(f"Unknown packet type code: {type_code}") from None
+    packet = _new_packet(Packet)
+    _set_packet_type(packet, packet_type)
+    _set_current_ip(packet, current_ip if flags & FLAG_CURRENT_IP else None)
+    _set_offering_ip(packet, offering_ip if flags & FLAG_OFFERING_IP else None)
+    _set_tid1(packet, tid1 if flags & FLAG_TID1 else None)
+    _set_tid2(packet, tid2 if flags & FLAG_TID2 else None)
+    return packet
+
+
+def encode_packet(packet):
+    """Encode a packet into its fixed-size binary wire form"""
+    return WIRE_FORMAT.pack(WIRE_VERSION, *_wire_fields(packet))
+
+
+def decode_packet(data):
+    """Decode bytes produced by encode_packet back into a Packet"""
+    if len(data) != WIRE_FORMAT.size:
+        raise ValueError(f"Bad packet length: {len(data)} bytes")
+    version, *fields = WIRE_FORMAT.unpack(data)
+    if version != WIRE_VERSION:
+        raise ValueError(f"Unsupported wire version: {version}")
+    return _build_packet(*fields)
+
+
+def encode_batch(packets):
+    """Encode packets into one contiguous batch payload"""
+    count = len(packets)
+    if count > BATCH_LIMIT:
+        raise ValueError(f"Batch of {count} packets exceeds limit of {BATCH_LIMIT}")
+    record_size = BATCH_RECORD.size
+    buffer = bytearray(BATCH_HEADER.size + count * record_size)
+    BATCH_HEADER.pack_into(buffer, 0, BATCH_VERSION, count)
+    pack_into = BATCH_RECORD.pack_into
+    offset = BATCH_HEADER.size
+    for packet in packets:
+        pack_into(buffer, offset, *_wire_fields(packet))
+        offset += record_size
+    return bytes(buffer)
+
+
+def decode_batch(data):
+    """Decode a batch payload into a list of packets"""
+    if len(data) < BATCH_HEADER.size:
+        raise ValueError(f"Bad batch length: {len(data)} bytes")
+    version, count = BATCH_HEADER.unpack_from(data)
+    if version != BATCH_VERSION:
+        raise ValueError(f"Unsupported batch version: {version}")
+    if len(data) != BATCH_HEADER.size + count * BATCH_RECORD.size:
+        raise ValueError(f"Bad batch length: {len(data)} bytes for {count} packets")
+    records = memoryview(data)[BATCH_HEADER.size:]
+    return [_build_packet(*fields) for fields in BATCH_RECORD.iter_unpack(records)]
@@ -0,0 +1,36 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """Token bucket: refills at rate tokens per second, holding at most burst.
+
+    A rate of 0 (or less) disables the limit and every acquire succeeds.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_acquire(self, tokens=1):
+        """Take tokens if available; returns False (taking nothing) if not"""
+        if self.rate <= 0:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < tokens:
+                return False
+            self.tokens -= tokens
+            return True
+
+    def refund(self, tokens=1):
+        """Give back tokens taken by a try_acquire whose work was not done after all"""
+        if self.rate <= 0:
+            return
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + tokens)
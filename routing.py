@@ -0,0 +1,128 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class RoutingCache:
+    """Bounded transaction-ID -> connection map with per-entry TTL.
+
+    Entries are kept in least-recently-written order: writing a route moves it
+    to the back, and when the cache is full the least recently written route
+    is evicted. Routes with the same TTL expire in the order they were
+    written, so each TTL also keeps its own write order and expired routes
+    are purged from the front of each as new ones arrive; a short-lived
+    route never waits behind a longer-lived one. A per-connection index lets
+    all routes of a closed connection be dropped at once.
+    """
+
+    def __init__(self, default_ttl=240.0, max_size=100000):
+        self.default_ttl = default_ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.routes = OrderedDict()  # {tid: (connection, expires_at, ttl)}
+        self.by_ttl = {}  # {ttl: OrderedDict({tid: None}) in write order}
+        self.by_connection = {}  # {connection: {tid, ...}}
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted_lru = 0
+        self.evicted_disconnect = 0
+
+    def __len__(self):
+        return len(self.routes)
+
+    def __contains__(self, tid):
+        return self.get(tid) is not None
+
+    def put(self, tid, connection, ttl=None):
+        """Add or refresh the route for tid"""
+        now = time.monotonic()
+        if ttl is None:
+            ttl = self.default_ttl
+        with self.lock:
+            previous = self.routes.pop(tid, None)
+            if previous is not None:
+                self._unindex(tid, previous)
+            self.routes[tid] = (connection, now + ttl, ttl)
+            self.by_connection.setdefault(connection, set()).add(tid)
+            order = self.by_ttl.get(ttl)
+            if order is None:
+                order = self.by_ttl[ttl] = OrderedDict()
+            order[tid] = None
+            self._purge_expired(now)
+            while len(self.routes) > self.max_size:
+                old_tid, old_entry = self.routes.popitem(last=False)
+                self._unindex(old_tid, old_entry)
+                self.evicted_lru += 1
+
+    def get(self, tid):
+        """Return the connection for tid, or None if unknown or expired"""
+        with self.lock:
+            entry = self.routes.get(tid)
+            if entry is None:
+                self.misses += 1
+                return None
+            connection, expires_at, _ = entry
+            if expires_at <= time.monotonic():
+                del self.routes[tid]
+                self._unindex(tid, entry)
+                self.expired += 1
+                self.misses += 1
+                return None
+            self.hits += 1
+            return connection
+
+    def discard(self, tid):
+        """Forget the route for tid, e.g. once its transaction is closed"""
+        with self.lock:
+            entry = self.routes.pop(tid, None)
+            if entry is not None:
+                self._unindex(tid, entry)
+
+    def remove_connection(self, connection):
+        """Drop every route that points at connection; returns their tids"""
+        with self.lock:
+            tids = self.by_connection.pop(connection, set())
+            for tid in tids:
+                self._unindex(tid, self.routes.pop(tid))
+            self.evicted_disconnect += len(tids)
+            return tids
+
+    def stats(self):
+        """Current size, lookup and eviction counters"""
+        with self.lock:
+            return {
+                'size': len(self.routes),
+                'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'evicted_lru': self.evicted_lru,
+                'evicted_disconnect': self.evicted_disconnect,
+            }
+
+    def _purge_expired(self, now):
+        # Routes near the front of each TTL's order were written longest ago;
+        # stop at the first live one
+        routes = self.routes
+        for order in list(self.by_ttl.values()):
+            while order:
+                tid = next(iter(order))
+                entry = routes[tid]
+                if entry[1] > now:
+                    break
+                del routes[tid]
+                self._unindex(tid, entry)
+                self.expired += 1
+
+    def _unindex(self, tid, entry):
+        # Drop tid, whose entry was just removed from routes, from the indexes
+        connection, _, ttl = entry
+        tids = self.by_connection.get(connection)
+        if tids is not None:
+            tids.discard(tid)
+            if not tids:
+                del self.by_connection[connection]
+        order = self.by_ttl[ttl]
+        del order[tid]
+        if not order:
+            del self.by_ttl[ttl]
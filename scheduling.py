@@ -0,0 +1,90 @@
+import threading
+import time
+from collections import deque
+from packet import DISCOVER, REQUEST, NOT_NEEDED, RELEASE, KEEPALIVE
+
+# Priority classes, most urgent first. Packets that keep existing leases
+# alive or give addresses back must not wait behind a DISCOVER storm.
+PRIORITY_LEASE = 0
+PRIORITY_DECLINE = 1
+PRIORITY_DISCOVER = 2
+PRIORITY_NAMES = ('lease', 'decline', 'discover')
+
+PACKET_PRIORITY = {
+    RELEASE: PRIORITY_LEASE,
+    KEEPALIVE: PRIORITY_LEASE,
+    REQUEST: PRIORITY_LEASE,
+    NOT_NEEDED: PRIORITY_DECLINE,
+    DISCOVER: PRIORITY_DISCOVER,
+}
+
+
+class PriorityScheduler:
+    """Bounded FIFO queue per priority class, drained most urgent class first.
+
+    put() never blocks: an item arriving at a full class queue is dropped and
+    counted. take() records how long each item waited, per class.
+    """
+
+    def __init__(self, max_queued=10000):
+        self.max_queued = max_queued
+        self.queues = [deque() for _ in PRIORITY_NAMES]
+        self.condition = threading.Condition()
+        self.enqueued = [0] * len(PRIORITY_NAMES)
+        self.dropped = [0] * len(PRIORITY_NAMES)
+        self.dispatched = [0] * len(PRIORITY_NAMES)
+        self.wait_total = [0.0] * len(PRIORITY_NAMES)
+        self.wait_max = [0.0] * len(PRIORITY_NAMES)
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues)
+
+    def put(self, priority, item):
+        """Queue item in its class; returns False if the class queue is full"""
+        with self.condition:
+            queue = self.queues[priority]
+            if len(queue) >= self.max_queued:
+                self.dropped[priority] += 1
+                return False
+            queue.append((time.monotonic(), item))
+            self.enqueued[priority] += 1
+            self.condition.notify()
+        return True
+
+    def take(self, limit):
+        """Remove up to limit items, most urgent class first, without blocking"""
+        items = []
+        now = time.monotonic()
+        with self.condition:
+            for priority, queue in enumerate(self.queues):
+                while queue and len(items) < limit:
+                    queued_at, item = queue.popleft()
+                    waited = now - queued_at
+                    self.wait_total[priority] += waited
+                    if waited > self.wait_max[priority]:
+                        self.wait_max[priority] = waited
+                    self.dispatched[priority] += 1
+                    items.append(item)
+        return items
+
+    def wait(self, timeout=None):
+        """Block until at least one item is queued (or timeout); returns whether one is"""
+        with self.condition:
+            return self.condition.wait_for(self.__len__, timeout)
+
+    def stats(self):
+        """Per-class queue depth, counters and queueing latency in seconds"""
+        with self.condition:
+            return {
+                name: {
+                    'queued': len(self.queues[priority]),
+                    'enqueued': self.enqueued[priority],
+                    'dropped': self.dropped[priority],
+                    'dispatched': self.dispatched[priority],
+                    'wait_total': self.wait_total[priority],
+                    'wait_avg': (self.wait_total[priority] / self.dispatched[priority]
+                                 if self.dispatched[priority] else 0.0),
+                    'wait_max': self.wait_max[priority],
+                }
+                for priority, name in enumerate(PRIORITY_NAMES)
+            }
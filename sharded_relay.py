@@ -0,0 +1,95 @@
+import multiprocessing
+import os
+import signal
+import socket
+from broadcast_server import BroadcastServer, bind_unix_listener
+from logs import get_logger
+
+log = get_logger('relay')
+
+
+def run_worker(worker_id, pairs, server_class, options, unix_listener=None):
+    """Run one relay worker, linked to its siblings by the socketpairs in pairs"""
+    peer_sockets = []
+    for (i, j), (end_i, end_j) in pairs.items():
+        # Every worker inherits every socketpair through fork; keep only our ends
+        if worker_id == i:
+            peer_sockets.append((j, end_i))
+            end_j.close()
+        elif worker_id == j:
+            peer_sockets.append((i, end_j))
+            end_i.close()
+        else:
+            end_i.close()
+            end_j.close()
+
+    if options.get('metrics_port') is not None:
+        # Each worker serves its own metrics on the next port up
+        options = dict(options, metrics_port=options['metrics_port'] + worker_id)
+    server = server_class(reuse_port=True, **options)
+    for peer_id, peer_socket in peer_sockets:
+        server.add_peer_link(peer_socket, f"worker-{peer_id}")
+    if unix_listener is not None:
+        server.add_unix_listener(unix_listener)
+    log.info("Relay worker %s ready", worker_id)
+    server.start()
+
+
+def run_sharded(workers, server_class=BroadcastServer, **options):
+    """Start several relay processes sharing one port through SO_REUSEPORT.
+
+    The kernel spreads incoming connections over the workers. Every pair of
+    workers is joined by a socketpair used as a relay peer link, so a DISCOVER
+    accepted by any worker also reaches the DHCP servers registered with its
+    siblings, and replies find their way back by tid1/tid2 routes. Each worker
+    keeps its own clients and routing tables.
+
+    A Unix socket path can't be shared through SO_REUSEPORT, so it is bound
+    once here and every worker accepts on the inherited listener.
+    """
+    unix_path = options.pop('unix_path', None)
+    unix_listener = bind_unix_listener(unix_path) if unix_path is not None else None
+    pairs = {}
+    for i in range(workers):
+        for j in range(i + 1, workers):
+            pairs[i, j] = socket.socketpair()
+
+    context = multiprocessing.get_context('fork')
+    processes = []
+    for worker_id in range(workers):
+        process = context.Process(target=run_worker, name=f"relay-worker-{worker_id}",
+                                  args=(worker_id, pairs, server_class, options, unix_listener))
+        process.start()
+        processes.append(process)
+
+    # The workers own the link sockets now
+    for sockets in pairs.values():
+        for sock in sockets:
+            sock.close()
+
+    def terminate(signum, frame):
+        raise SystemExit(128 + signum)
+
+    # kill, systemd and docker stop send SIGTERM; leaving by the finally below
+    # makes sure no worker outlives us holding the port
+    previous = signal.signal(signal.SIGTERM, terminate)
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        log.info("Shutting down relay workers...")
+        for process in processes:
+            process.join()
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+        if unix_path is not None:
+            unix_listener.close()
+            try:
+                os.unlink(unix_path)
+            except FileNotFoundError:
+                pass
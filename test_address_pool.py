@@ -0,0 +1,61 @@
+import unittest
+from array import array
+from address_pool import AddressPool, parse_range
+
+
+class AddressPoolTest(unittest.TestCase):
+    def test_parse_range(self):
+        self.assertEqual(parse_range('10.0.0.0/30'), (0x0A000000, 0x0A000003))
+        self.assertEqual(parse_range('10.0.0.0/30', hosts_only=True), (0x0A000001, 0x0A000002))
+        self.assertEqual(parse_range('10.0.0.5-10.0.0.7'), (0x0A000005, 0x0A000007))
+        for bad in ('10.0.0.300', '10.0.0.7-10.0.0.5', '10.0.0.0/33', '10.1-10.0.0.5',
+                    '10.0.0.1-10.0.0.300'):
+            with self.assertRaises(ValueError):
+                parse_range(bad)
+
+    def test_freed_addresses_are_reused_last(self):
+        pool = AddressPool.from_specs(['10.0.0.0/30'])  # hosts .1 and .2
+        first = pool.allocate()
+        pool.free(first)
+        self.assertEqual([pool.allocate() for _ in range(2)], ['10.0.0.2', first])
+        self.assertIsNone(pool.allocate())
+
+    def test_free_only_takes_back_allocated_addresses(self):
+        pool = AddressPool.from_specs(['10.0.0.0/30'])
+        self.assertFalse(pool.free('10.0.0.1'))
+        self.assertFalse(pool.free('10.0.1.1'))
+        ip = pool.allocate()
+        self.assertTrue(pool.is_allocated(ip))
+        self.assertTrue(pool.free(ip))
+        self.assertFalse(pool.free(ip))
+        self.assertEqual(pool.free_count, 2)
+
+    def test_ranges_and_exclusions(self):
+        pool = AddressPool.from_specs(['10.0.0.0/29', '10.0.1.0/30'], ['10.0.0.2-10.0.0.6'])
+        self.assertEqual(len(pool), 3)
+        self.assertNotIn('10.0.0.4', pool)
+        self.assertEqual([pool.allocate() for _ in range(3)], ['10.0.0.1', '10.0.1.1', '10.0.1.2'])
+
+    def test_hold(self):
+        pool = AddressPool.from_specs(['10.0.0.0/29', '10.0.1.0/30'])
+        found = pool.hold(array('I', [0x0A000001, 0x0A000003, 0x0A000101, 0x0B000000]))
+        self.assertEqual(found, 3)
+        self.assertEqual(pool.used_count, 3)
+        self.assertTrue(pool.is_allocated('10.0.1.1'))
+        self.assertEqual(list(pool.allocated_addresses()), ['10.0.0.1', '10.0.0.3', '10.0.1.1'])
+        self.assertEqual(pool.allocate(), '10.0.0.2')
+        self.assertEqual(pool.allocate(), '10.0.0.4')
+        self.assertTrue(pool.free('10.0.0.3'))
+        self.assertFalse(pool.free('10.0.0.3'))
+        self.assertFalse(pool.reserve('10.0.1.1'))
+        self.assertEqual(pool.free_count, 8 - 4)
+
+    def test_allocate_passes_held_runs(self):
+        pool = AddressPool.from_specs(['10.0.0.0/29', '10.0.1.0/30'])
+        pool.hold(array('I', list(range(0x0A000001, 0x0A000007)) + [0x0A000101]))
+        pool.free('10.0.0.3')
+        self.assertEqual(list(pool.free_addresses()), ['10.0.1.2', '10.0.0.3'])
+        self.assertEqual([pool.allocate() for _ in range(3)], ['10.0.1.2', '10.0.0.3', None])
+
+if __name__ == '__main__':
+    unittest.main()
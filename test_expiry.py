@@ -0,0 +1,33 @@
+import unittest
+from expiry import ExpiryQueue
+
+
+class ExpiryQueueTest(unittest.TestCase):
+    def test_expires_in_deadline_order(self):
+        queue = ExpiryQueue()
+        queue.set_many([('a', 3.0), ('b', 1.0)])
+        queue.set('c', 2.0)
+        self.assertEqual(queue.next_deadline(), 1.0)
+        self.assertEqual(queue.pop_expired(2.5), ['b', 'c'])
+        self.assertEqual(len(queue), 1)
+
+    def test_set_many(self):
+        queue = ExpiryQueue()
+        queue.set('a', 1.0)
+        queue.set_many([('a', 4.0), ('b', 2.0), ('c', 3.0)])
+        self.assertEqual(queue.pop_expired(3.0), ['b', 'c'])
+        self.assertEqual(queue.get('a'), 4.0)
+
+    def test_superseded_and_discarded_entries_are_skipped(self):
+        queue = ExpiryQueue()
+        queue.set('a', 1.0)
+        queue.set('a', 5.0)
+        queue.set('b', 2.0)
+        queue.discard('b')
+        self.assertEqual(queue.pop_expired(4.0), [])
+        self.assertEqual(queue.next_deadline(), 5.0)
+        self.assertEqual(queue.pop_expired(5.0), ['a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import lease_store
+from lease_store import LeaseStore, MAGIC, RECORD
+
+
+class LeaseStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def reopen(self, store):
+        store.close()
+        store = LeaseStore(self.directory)
+        self.addCleanup(store.close)
+        return store
+
+    def journal_path(self, store):
+        return store.path(store.generation, 'log')
+
+    def test_lease_and_release_survive_restart(self):
+        store = LeaseStore(self.directory)
+        store.lease(11, 1, '10.0.0.1', 1000.0)
+        store.lease(12, 2, '10.0.0.2', 2000.0)
+        store.lease(11, 1, '10.0.0.1', 3000.0)
+        store.release(12)
+        store = self.reopen(store)
+        self.assertEqual(len(store), 1)
+        self.assertEqual(store.get(11), (1, 0x0A000001, 3000.0))
+        self.assertIsNone(store.get(12))
+
+    def test_torn_tail_is_truncated(self):
+        store = LeaseStore(self.directory)
+        store.lease(11, 1, '10.0.0.1', 1000.0)
+        store.close()
+        with open(self.journal_path(store), 'ab') as f:
+            f.write(b'\x01\x02\x03')  # a record cut short by a crash
+
+        store = LeaseStore(self.directory)
+        self.assertEqual(os.path.getsize(self.journal_path(store)), len(MAGIC) + RECORD.size)
+        store.lease(12, 2, '10.0.0.2', 2000.0)
+        store.lease(13, 3, '10.0.0.3', 3000.0)
+        store = self.reopen(store)
+        self.assertEqual(os.path.getsize(self.journal_path(store)), len(MAGIC) + 3 * RECORD.size)
+        self.assertEqual([store.get(tid2) for tid2 in (11, 12, 13)],
+                         [(1, 0x0A000001, 1000.0), (2, 0x0A000002, 2000.0), (3, 0x0A000003, 3000.0)])
+
+    def test_snapshot_round_trip(self):
+        self.patch_snapshot_threshold()
+        store = LeaseStore(self.directory)
+        for tid2 in range(10):
+            store.lease(tid2, tid2, f'10.0.0.{tid2 + 1}', 1000.0 + tid2)
+        store.sync()
+        store.release(3)
+        store = self.reopen(store)
+        self.assertTrue(os.path.exists(store.path(store.generation, 'snap')))
+        self.assertEqual(len(store), 9)
+        self.assertIsNone(store.get(3))
+        self.assertEqual(store.get(9), (9, 0x0A00000A, 1009.0))
+        self.assertEqual(list(store.base_addresses), list(range(0x0A000001, 0x0A00000B)))
+        self.assertEqual(store.changed_addresses(), ([0x0A000004], []))
+
+    def test_on_durable_runs_after_commit(self):
+        store = LeaseStore(self.directory)
+        self.addCleanup(store.close)
+        durable_at_callback = []
+        called = threading.Event()
+
+        def on_durable():
+            durable_at_callback.append(store.durable)
+            called.set()
+
+        store.lease(11, 1, '10.0.0.1', 1000.0, on_durable=on_durable)
+        self.assertTrue(called.wait(5))
+        self.assertEqual(durable_at_callback, [1])
+
+    def patch_snapshot_threshold(self):
+        saved = lease_store.SNAPSHOT_MIN_RECORDS
+        lease_store.SNAPSHOT_MIN_RECORDS = 10  # exactly the leases the test makes
+        self.addCleanup(setattr, lease_store, 'SNAPSHOT_MIN_RECORDS', saved)
+
+
+if __name__ == '__main__':
+    unittest.main()
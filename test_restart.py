@@ -0,0 +1,78 @@
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from broadcast_server import BroadcastServer
+from dhcpserver1 import DHCPServer
+from framing import FrameBuffer, recv_frame, send_frame
+from packet import Packet, DISCOVER, OFFER, REQUEST, ACK, KEEPALIVE, RELEASE, CLOSEACK, POOL_STATUS
+
+
+class RestartTest(unittest.TestCase):
+    """A server restarted on its lease directory keeps answering for its leases"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.relay = BroadcastServer(port=0, heartbeat_interval=0)
+        self.addCleanup(self.relay.server_socket.close)
+        threading.Thread(target=self.relay.start, daemon=True).start()
+        self.port = self.relay.server_socket.getsockname()[1]
+
+    def start_server(self):
+        server = DHCPServer(server_id=1, broadcast_port=self.port, pool=['10.0.0.0/29'],
+                            lease_dir=self.directory)
+        self.assertTrue(server.connect_to_broadcast())
+        for target in (server.receive_messages, server.report_pool_status):
+            threading.Thread(target=target, daemon=True).start()
+        self.wait_for(lambda: server.socket.getsockname() in
+                      [owner.getpeername() for owner in self.relay.tid2_prefix_owners.values()])
+        return server
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, "timed out")
+            time.sleep(0.01)
+
+    def exchange(self, client, buffer, packet):
+        # Send packet, return the first reply that isn't a pool advertisement
+        send_frame(client, packet.serialize())
+        while True:
+            reply = Packet.decode_many(recv_frame(client, buffer))[0]
+            if reply.packet_type is not POOL_STATUS:
+                return reply
+
+    def test_keepalive_after_restart(self):
+        server = self.start_server()
+        client = socket.create_connection(('localhost', self.port))
+        self.addCleanup(client.close)
+        client.settimeout(5)
+        send_frame(client, b"CLIENT")
+        buffer = FrameBuffer()
+
+        offer = self.exchange(client, buffer, Packet(tid1=7, packet_type=DISCOVER))
+        self.assertIs(offer.packet_type, OFFER)
+        ack = self.exchange(client, buffer, offer.replace(packet_type=REQUEST))
+        self.assertIs(ack.packet_type, ACK)
+
+        server.socket.shutdown(socket.SHUT_RDWR)  # as if the process died
+        server.disconnect()
+        self.wait_for(lambda: not self.relay.dhcp_servers)
+        server = self.start_server()
+        self.addCleanup(server.disconnect)
+        self.assertEqual(server.pool.used_count, 1)
+
+        # The relay must route to the new server rather than NAK the dead one's tid2
+        send_frame(client, ack.replace(packet_type=KEEPALIVE, offering_ip=None).serialize())
+        closeack = self.exchange(client, buffer, ack.replace(packet_type=RELEASE, offering_ip=None))
+        self.assertIs(closeack.packet_type, CLOSEACK)
+        self.assertEqual(closeack.tid2, ack.tid2)
+        self.assertEqual(server.pool.used_count, 0)
+        self.assertEqual(len(server.lease_store), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()